@@ -0,0 +1,341 @@
+import hashlib
+import os
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import xarray as xr
+
+import catalog
+import metrics
+import regions
+
+# Define directory to store the daily aggregates in (one sub-directory per region and product, one NetCDF file per day)
+daily_dir = 'Products_Daily/'
+
+# Define directory to cache the period means in (one sub-directory per region)
+mean_dir = 'Products_Mean/'
+
+# Define attributes for each pollutant (Product: [HARP field name, description, min value, max value, unit, layer]). The table is
+# shared by all stages; the value range of the maps and tiles may be adjusted if inadequate
+product_attributes = {
+    'HCHO': ['tropospheric_HCHO_column_number_density', 'Tropospheric HCHO column number density', 0, 0.0007, 'mol / m$^{2}$', 'troposphere'],
+    'NO2': ['tropospheric_NO2_column_number_density', 'Tropospheric vertical column of NO2', 0, 0.0002, 'mol / m$^{2}$', 'troposphere'],
+    'SO2': ['SO2_column_number_density', 'SO2 vertical column density', 0, 0.003, 'mol / m$^{2}$', 'troposphere'],
+    'CH4': ['CH4_column_volume_mixing_ratio_dry_air', 'Column averaged dry air mixing ratio of methane', 1400, 2000, 'ppbv', 'atmosphere'],
+    'CO': ['CO_column_number_density', 'Vertically integrated CO column density', 0, 0.05, 'mol / m$^{2}$', 'atmosphere']
+}
+
+# Define the time the daily aggregates and period means are kept for
+retention_time = timedelta(weeks=8)
+
+# Define the data type the sums of the daily aggregates and the period means are accumulated and stored in ('float32' halves the
+# memory and disk space of the grids, 'float64' for full precision)
+accumulator_dtype = 'float32'
+
+# Define the memory budget (bytes) of the working arrays of a period mean. The daily aggregates are read in blocks of grid rows
+# small enough to stay within the budget, so the memory does not grow with the number of days or granules
+memory_budget = 256 * 1024 ** 2
+
+# Define the number of grid rows per chunk of the daily aggregate files (the blocks read by the period means are multiples of it)
+chunk_rows = 64
+
+# Period means that were already calculated in this process, keyed by region, product, time period and input key
+mean_cache = {}
+
+
+# Return the path of the daily aggregate file of a product
+def daily_path(region, product, day):
+    return os.path.join(daily_dir, region, product, f'{product}_{day}.nc')
+
+
+# Read the window of an L3 file containing valid cells, its offset (row, column) into the full grid and the coordinates of the
+# full grid. Compact L3 files only store the window, files exported by HARP store the full grid (offset 0, 0)
+def read_l3_window(file, attribute):
+    with xr.open_dataset(file) as ds:
+        grid = ds[attribute]
+        if 'time' in grid.dims:
+            grid = grid.isel(time=0)
+        window = grid.values.astype(accumulator_dtype, copy=False)
+        if 'grid_latitude' not in ds:
+            return window, 0, 0, ds['latitude'].values, ds['longitude'].values
+        return window, ds.attrs['row_offset'], ds.attrs['column_offset'], ds['grid_latitude'].values, ds['grid_longitude'].values
+
+
+# Add (sign 1) or subtract (sign -1) the valid cells of an L3 window to the sum and number of observations of a daily aggregate.
+# Only the cells of the window are touched
+def add_window(grid_sum, grid_count, window, row, column, sign=1):
+    sum_window = grid_sum[row:row + window.shape[0], column:column + window.shape[1]]
+    count_window = grid_count[row:row + window.shape[0], column:column + window.shape[1]]
+    valid = ~np.isnan(window)
+    sum_window[valid] += sign * window[valid]
+    count_window += sign * valid
+
+
+# Read the names of the L3 files contributing to the daily aggregate of a product (without reading the grids)
+def daily_sources(region, product, day):
+    if not os.path.exists(daily_path(region, product, day)):
+        return set()
+    with xr.open_dataset(daily_path(region, product, day)) as ds:
+        return set(ds.attrs.get('source_products', '').split())
+
+
+# Read the daily aggregate of a product (sum and number of valid observations per cell, and the contributing L3 files)
+def read_daily(region, product, day):
+    with xr.open_dataset(daily_path(region, product, day)) as ds:
+        ds.load()
+    sources = set(ds.attrs['source_products'].split()) if ds.attrs.get('source_products') else set()
+    return ds, sources
+
+
+# Write the daily aggregate of a product. The file is written under a temporary name and renamed once complete
+def write_daily(region, product, day, grid_sum, grid_count, latitude, longitude, sources):
+    ds = xr.Dataset(
+        {
+            'sum': (('latitude', 'longitude'), grid_sum.astype(accumulator_dtype, copy=False)),
+            'count': (('latitude', 'longitude'), grid_count.astype('int32')),
+        },
+        coords={'latitude': latitude, 'longitude': longitude},
+        attrs={'region': region, 'product': product, 'day': day, 'source_products': ' '.join(sorted(sources))}
+    )
+    path = daily_path(region, product, day)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    chunk = {'chunksizes': (min(chunk_rows, latitude.size), longitude.size)}
+    ds.to_netcdf(path + '.part', encoding={'sum': chunk, 'count': chunk})
+    os.replace(path + '.part', path)
+
+
+# Add the L3 files that are not yet part of the daily aggregates of a product. Only new files are read, so days that
+# were already aggregated by a previous run are not touched unless late-arriving products were added for that day.
+# The contributions of superseded L3 files (e.g. NRTI products whose OFFL product of the same orbit arrived) are subtracted
+# from the aggregates, and superseded files are not added. If a superseded file was already deleted, its day is rebuilt
+# from the remaining files. The files are assigned to their day by the sensing day of their product in the catalog
+# (catalog.sensing_days). One L3 file is read at a time and only its window of valid cells is added to the running sum and
+# number of observations, so the memory does not grow with the number of files. Returns the files that are part of the daily aggregates
+def update_daily_store(region, product, files, attribute, days, superseded=()):
+    superseded_files = {os.path.basename(file): file for file in superseded}
+    files_by_day = {}
+    for file in superseded:
+        files_by_day.setdefault(days[catalog.file_identifier(file)], [])
+    for file in files:
+        if os.path.basename(file) not in superseded_files:
+            files_by_day.setdefault(days[catalog.file_identifier(file)], []).append(file)
+    aggregated = []
+
+    for day, day_files in sorted(files_by_day.items()):
+        sources = daily_sources(region, product, day)
+        new_files = [file for file in day_files if os.path.basename(file) not in sources]
+        replaced_files = [file for name, file in superseded_files.items() if name in sources]
+        if not new_files and not replaced_files:
+            aggregated += day_files
+            continue
+        rebuild = not all(os.path.exists(file) for file in replaced_files)
+        if os.path.exists(daily_path(region, product, day)) and not rebuild:
+            ds, sources = read_daily(region, product, day)
+            grid_sum, grid_count = ds['sum'].values.astype(accumulator_dtype), ds['count'].values.astype('int32')
+            latitude, longitude = ds['latitude'].values, ds['longitude'].values
+        else:
+            sources = set()
+            grid_sum = grid_count = latitude = longitude = None
+            new_files = day_files
+        for file in [] if rebuild else replaced_files:
+            window, row, column, _, _ = read_l3_window(file, attribute)
+            add_window(grid_sum, grid_count, window, row, column, sign=-1)
+            sources.discard(os.path.basename(file))
+        for file in new_files:
+            try:
+                window, row, column, latitude, longitude = read_l3_window(file, attribute)
+            except Exception as error:
+                print(f'Error: {error}. Skipping {file}.')
+                continue
+            if grid_sum is None:
+                grid_sum = np.zeros((latitude.size, longitude.size), dtype=accumulator_dtype)
+                grid_count = np.zeros((latitude.size, longitude.size), dtype='int32')
+            elif (latitude.size, longitude.size) != grid_sum.shape:
+                print(f'Error: grid of {file} differs from the daily aggregate of {day} (grid cell size changed). Skipping {file}.')
+                continue
+            add_window(grid_sum, grid_count, window, row, column)
+            sources.add(os.path.basename(file))
+        if grid_sum is not None:
+            grid_sum[grid_count == 0] = 0   # no rounding residue of subtracted contributions in empty cells
+            write_daily(region, product, day, grid_sum, grid_count, latitude, longitude, sources)
+            print(f'{region} {product} {day}: added {len(new_files)} and replaced {len(replaced_files)} superseded product(s) in the daily aggregate')
+        elif os.path.exists(daily_path(region, product, day)):
+            os.remove(daily_path(region, product, day))
+            sources = set()
+        aggregated += [file for file in day_files if os.path.basename(file) in sources]
+    return aggregated
+
+
+# Return the days of a product with a daily aggregate in a time period
+def period_days(region, product, start_date, end_date):
+    product_dir = os.path.join(daily_dir, region, product)
+    if not os.path.isdir(product_dir):
+        return []
+    days = sorted(
+        filename[len(product) + 1:-3] for filename in os.listdir(product_dir)
+        if filename.startswith(f'{product}_') and filename.endswith('.nc')
+    )
+    return [day for day in days if start_date <= datetime.strptime(day, '%Y%m%d') <= end_date]
+
+
+# Calculate the mean of a product over a time period from its daily aggregates (mean of the daily means).
+# Days aggregated on a different grid than the most recent day (grid cell size changed) are left out.
+# The daily aggregates are read in blocks of grid rows sized to the memory budget, all days of a block at a time, so only the
+# resulting mean is held in memory for the full grid. Returns None if no daily aggregates are available in the time period
+def period_mean(region, product, start_date, end_date, attribute):
+    days = period_days(region, product, start_date, end_date)
+    if not days:
+        return None
+
+    datasets = []
+    try:
+        for day in reversed(days):
+            ds = xr.open_dataset(daily_path(region, product, day))
+            if datasets and ds['sum'].shape != datasets[0]['sum'].shape:
+                print(f'Error: {region} {product} {day} was aggregated on a different grid. Skipping {day}.')
+                ds.close()
+                continue
+            datasets.append(ds)
+        latitude, longitude = datasets[0]['latitude'].values, datasets[0]['longitude'].values
+
+        # Working arrays per cell: sum and mean of the block (accumulator), daily sum, daily mean, count and valid mask of a day
+        bytes_per_cell = 3 * np.dtype(accumulator_dtype).itemsize + 2 * 4 + 1
+        block_rows = max(memory_budget // (longitude.size * bytes_per_cell) // chunk_rows, 1) * chunk_rows
+        mean = np.empty((latitude.size, longitude.size), dtype=accumulator_dtype)
+        for first_row in range(0, latitude.size, block_rows):
+            block = slice(first_row, min(first_row + block_rows, latitude.size))
+            mean_sum = np.zeros((block.stop - block.start, longitude.size), dtype=accumulator_dtype)
+            mean_count = np.zeros(mean_sum.shape, dtype='int32')
+            for ds in datasets:
+                grid_count = ds['count'][block].values
+                valid = grid_count > 0
+                mean_sum[valid] += ds['sum'][block].values[valid] / grid_count[valid]
+                mean_count += valid
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean[block] = np.where(mean_count > 0, mean_sum / mean_count, np.nan)
+    finally:
+        for ds in datasets:
+            ds.close()
+    return xr.DataArray(mean, dims=('latitude', 'longitude'), coords={'latitude': latitude, 'longitude': longitude}, name=attribute)
+
+
+# Return a key identifying the daily aggregates a period mean is calculated from. The key changes whenever a daily
+# aggregate of the time period is added or updated
+def input_key(region, product, days):
+    key = hashlib.sha1()
+    for day in days:
+        status = os.stat(daily_path(region, product, day))
+        key.update(f'{day}:{status.st_mtime_ns}:{status.st_size};'.encode())
+    return key.hexdigest()
+
+
+# Return the mean of a product over a time period, calculating it only if the daily aggregates it is based on changed.
+# Means are cached in memory and on disk, so every output (PNG, JPG, GeoTIFF) of a run shares a single calculation
+def cached_period_mean(region, product, start_date, end_date, attribute):
+    days = period_days(region, product, start_date, end_date)
+    if not days:
+        return None
+    key = input_key(region, product, days)
+    if (region, product, days[0], days[-1], key) in mean_cache:
+        return mean_cache[(region, product, days[0], days[-1], key)]
+
+    path = os.path.join(mean_dir, region, f'{product}_{start_date.strftime("%Y%m%d")}-{end_date.strftime("%Y%m%d")}.nc')
+    mean = None
+    if os.path.exists(path):
+        with xr.open_dataset(path) as ds:
+            if ds.attrs.get('input_key') == key:
+                mean = ds[attribute].load()
+    if mean is None:
+        mean = period_mean(region, product, start_date, end_date, attribute)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        mean.to_dataset().assign_attrs(input_key=key, region=region, product=product).to_netcdf(path + '.part')
+        os.replace(path + '.part', path)
+    mean_cache[(region, product, days[0], days[-1], key)] = mean
+    return mean
+
+
+# Upsample a mean onto a regular grid with the given cell size (degrees), using the value of the nearest cell.
+# Only used when rendering outputs that need the same grid for every product, the stored means keep their native grid
+def upsample(mean, cell_size):
+    latitude = np.arange(mean['latitude'].values.min(), mean['latitude'].values.max() + cell_size / 2, cell_size)
+    longitude = np.arange(mean['longitude'].values.min(), mean['longitude'].values.max() + cell_size / 2, cell_size)
+    return mean.sortby(['latitude', 'longitude']).reindex(latitude=latitude, longitude=longitude, method='nearest')
+
+
+# Return the mean of every product of a region over its time period ending at the given date (see catalog.mean_period), calculated
+# once with cached_period_mean and shared by the render, export and zonal stages. If a cell size is given, the means are upsampled
+# to it. Products without data in their time period are left out. If a stage is given, the time of every mean is recorded as event
+# of the stage. Returns the means and the time periods of the products
+def region_means(region, current_date, cell_size=None, stage=None):
+    means = {}
+    periods = {}
+    for product, attributes in product_attributes.items():
+        print(f'Reading {region} {product} files...')
+        start_time = time.perf_counter()
+        start_date, end_date = catalog.mean_period(product, current_date)
+        mean = cached_period_mean(region, product, start_date, end_date, attributes[0])
+        if mean is None:
+            print(f'Error: no {region} {product} data available between {start_date.date()} and {end_date.date()}.')
+            continue
+        means[product] = mean if cell_size is None else upsample(mean, cell_size)
+        periods[product] = (start_date, end_date)
+        if stage is not None:
+            metrics.record(stage, 'mean', region=region, product=product, seconds=round(time.perf_counter() - start_time, 3))
+    return means, periods
+
+
+# Delete cached period means of a region that are older than the given date
+def delete_expired_means(region, oldest_date):
+    region_dir = os.path.join(mean_dir, region)
+    if not os.path.isdir(region_dir):
+        return
+    for filename in os.listdir(region_dir):
+        if filename.endswith('.nc') and datetime.strptime(filename[-11:-3], '%Y%m%d') < oldest_date:
+            os.remove(os.path.join(region_dir, filename))
+            print(f'Deleted: {os.path.join(region_dir, filename)}')
+
+
+# Delete daily aggregates of a product of a region that are older than the given date
+def delete_expired_days(region, product, oldest_date):
+    product_dir = os.path.join(daily_dir, region, product)
+    if not os.path.isdir(product_dir):
+        return
+    for filename in os.listdir(product_dir):
+        if not (filename.startswith(f'{product}_') and filename.endswith('.nc')):
+            continue
+        if datetime.strptime(filename[len(product) + 1:-3], '%Y%m%d') < oldest_date:
+            os.remove(os.path.join(product_dir, filename))
+            print(f'Deleted: {os.path.join(product_dir, filename)}')
+
+
+# Update the daily aggregates of the products of a region (default: all products) from the catalog: add new L3 files, replace
+# superseded L3 files and record the aggregated files. Daily aggregates and period means older than the retention time are deleted.
+# Every stage adding L3 files to the daily aggregates (aggregate, pipeline, benchmark) calls this function, the update of every
+# product is recorded as event of the given stage. Returns the number of aggregated files of every product
+def update_region(region, stage, products=None):
+    oldest_date = datetime.now() - retention_time
+    days = catalog.sensing_days(products)
+    aggregated = {}
+    for product in products or product_attributes:
+        start_time = time.perf_counter()
+        files = update_daily_store(region, product, catalog.l3_files(region, [product]), product_attributes[product][0], days,
+                                   catalog.superseded_l3_files(region, [product]))
+        catalog.set_aggregated(region, files)
+        metrics.record(stage, 'aggregate', region=region, product=product, files=len(files), seconds=round(time.perf_counter() - start_time, 3))
+        delete_expired_days(region, product, oldest_date)
+        aggregated[product] = len(files)
+    delete_expired_means(region, oldest_date)
+    return aggregated
+
+
+# Update the daily aggregates of every region and product from the catalog and delete expired aggregates and means
+# (python aggregate.py, the aggregate stage of execute.py)
+if __name__ == '__main__':
+    measurement = metrics.start_stage('aggregate')
+    catalog.sync()
+    for region in regions.regions:
+        aggregated = update_region(region, 'aggregate')
+        metrics.add(measurement, 'files_aggregated', sum(aggregated.values()))
+        print(f'{region} aggregation complete')
+    metrics.finish_stage(measurement)
@@ -0,0 +1,94 @@
+import os
+import re
+from datetime import datetime
+from glob import glob
+from os.path import join
+
+import imageio.v2 as imageio
+import numpy as np
+from PIL import Image
+
+# Define the number of most recent outputs included in the animations
+animation_frames = 8
+
+# Define the display time of each frame (milliseconds)
+frame_duration = 1000
+
+# Define the format of the animations: 'gif', 'webp' (animated WebP) or 'mp4' (requires imageio-ffmpeg)
+animation_format = 'gif'
+
+# Define the size of the thumbnails of the frames the shared GIF palette is calculated from (pixels)
+palette_thumbnail_size = (256, 256)
+
+
+# Return the PNG outputs of a product in the dated output directories of a region, sorted by the end date of their time period.
+# Only file names are parsed, no image is read
+def product_frames(output_dir, product):
+    pattern = re.compile(rf'{product}_(\d{{4}}_\d{{2}}_\d{{2}})-(\d{{4}}_\d{{2}}_\d{{2}})\.png')
+    frames = []
+    for path in glob(join(output_dir, '*', f'{product}_*.png')):
+        match = pattern.fullmatch(os.path.basename(path))
+        if match:
+            frames.append((datetime.strptime(match.group(2), '%Y_%m_%d'), path))
+    return [path for _, path in sorted(frames)]
+
+
+# Read frames one at a time as RGB images with the size of the first frame (the size of the PNG outputs may differ slightly)
+def read_frames(paths):
+    size = None
+    for path in paths:
+        with Image.open(path) as image:
+            frame = image.convert('RGB')
+        if size is None:
+            size = frame.size
+        elif frame.size != size:
+            frame = frame.resize(size)
+        yield frame
+
+
+# Calculate a palette shared by all frames of a GIF from thumbnails of the frames, so the colours of all frames are represented
+def shared_palette(paths):
+    thumbnails = []
+    for frame in read_frames(paths):
+        frame.thumbnail(palette_thumbnail_size)
+        thumbnails.append(frame)
+    mosaic = Image.new('RGB', (sum(thumbnail.width for thumbnail in thumbnails), max(thumbnail.height for thumbnail in thumbnails)))
+    offset = 0
+    for thumbnail in thumbnails:
+        mosaic.paste(thumbnail, (offset, 0))
+        offset += thumbnail.width
+    return mosaic.quantize(colors=256, method=Image.Quantize.MEDIANCUT)
+
+
+# Write the frames to an animation file, reading one frame at a time. GIF frames are quantized to a shared palette and only the
+# area that changed from the previous frame is stored. The file is written under a temporary name and renamed once complete (the
+# temporary name keeps the extension, ffmpeg chooses the container by the extension)
+def write_animation(paths, path):
+    base, extension = os.path.splitext(path)
+    partial_path = f'{base}.part{extension}'
+    if animation_format == 'gif':
+        palette = shared_palette(paths)
+        frames = (frame.quantize(palette=palette, dither=Image.Dither.NONE) for frame in read_frames(paths))
+        first_frame = next(frames)
+        first_frame.save(partial_path, format='GIF', save_all=True, append_images=frames, loop=0, duration=frame_duration, optimize=True)
+    elif animation_format == 'webp':
+        frames = read_frames(paths)
+        first_frame = next(frames)
+        first_frame.save(partial_path, format='WEBP', save_all=True, append_images=frames, loop=0, duration=frame_duration, quality=80)
+    elif animation_format == 'mp4':
+        with imageio.get_writer(partial_path, format='FFMPEG', fps=1000 / frame_duration, codec='libx264', macro_block_size=2) as writer:
+            for frame in read_frames(paths):
+                writer.append_data(np.asarray(frame))
+    else:
+        raise ValueError(f'unknown animation format {animation_format}')
+    os.replace(partial_path, path)
+
+
+# Create an animation of the most recent PNG outputs of a product in the output directory of a region and return its path
+def animate_product(output_dir, product):
+    paths = product_frames(output_dir, product)[-animation_frames:]
+    if not paths:
+        raise ValueError('no outputs to animate')
+    path = f'{output_dir}{product}.{animation_format}'
+    write_animation(paths, path)
+    return path
@@ -0,0 +1,381 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+import harp
+import netCDF4
+import numpy as np
+
+import aggregate
+import animate
+import catalog
+import process
+import regions
+import render
+
+# Offline benchmark of the hot paths of the workflow. Synthetic Sentinel-5P L2 granules of all products are generated in an
+# empty working directory and converted, aggregated, averaged, rendered and animated with the functions of the stages.
+# The timings of every run are appended to a results file together with the commit, so runs can be compared across commits.
+# Usage: python benchmark.py [--granules 4] [--days 7] [--scanlines 600] [--ground-pixels 450] [--fail-on-regression]
+
+# Define the working directory of the benchmark (deleted and recreated by every run)
+benchmark_dir = 'Benchmark/'
+
+# Define the file the results of every run are appended to (one JSON line per run)
+results_path = 'Benchmark_Results/results.jsonl'
+
+# Define the version of the benchmark. Runs are only compared to previous runs of the same version (increase it when the work
+# measured by a stage changes)
+benchmark_version = 2
+
+# Define the slowdown of a stage compared to the previous run with the same configuration that is reported as regression
+# (fraction), stages faster than the minimum duration (seconds) are not compared as their timings are dominated by noise
+regression_threshold = 0.2
+regression_min_seconds = 0.5
+
+# Define the L2 variable of each product and the distribution of its synthetic values (Product: [variable, unit, mean, standard deviation])
+l2_variables = {
+    'HCHO': ['formaldehyde_tropospheric_vertical_column', 'mol m-2', 1.2e-4, 6e-5],
+    'NO2': ['nitrogendioxide_tropospheric_column', 'mol m-2', 4e-5, 3e-5],
+    'SO2': ['sulfurdioxide_total_vertical_column', 'mol m-2', 1e-4, 4e-4],
+    'CH4': ['methane_mixing_ratio', '1e-9', 1850, 20],
+    'CO': ['carbonmonoxide_total_column', 'mol m-2', 0.03, 0.008]
+}
+
+# Define the HARP units of the L2 units of the synthetic granules
+harp_units = {'mol m-2': 'mol/m^2', '1e-9': 'ppbv'}
+
+# Define the swath geometry of the synthetic granules: along-track pixel size and across-track swath half width (degrees),
+# latitude of the first scanline and drift of the ground track to the west per degree of latitude (ascending orbit)
+scanline_size = 0.05
+swath_half_width = 13
+first_latitude = -5
+track_drift = 0.14
+
+# Define the reference time of the L2 time variable
+time_reference = datetime(2010, 1, 1)
+
+
+# Return the file name of a synthetic L2 granule, following the Sentinel-5P naming convention
+def granule_name(product, start_time, end_time, orbit):
+    return f'S5P_OFFL_L2__{product:_<6}_{start_time:%Y%m%dT%H%M%S}_{end_time:%Y%m%dT%H%M%S}_{orbit:05d}_03_020500_{end_time + timedelta(days=3):%Y%m%dT%H%M%S}.nc'
+
+
+# Calculate the corners (scanline, ground pixel, 4) of the pixels of a swath from the pixel centres, half-way between
+# neighbouring centres (extrapolated at the swath edges)
+def pixel_corners(centres):
+    padded = np.pad(centres, 1, mode='reflect', reflect_type='odd')
+    edges = (padded[:-1, :-1] + padded[1:, :-1] + padded[:-1, 1:] + padded[1:, 1:]) / 4
+    return np.stack([edges[:-1, :-1], edges[:-1, 1:], edges[1:, 1:], edges[1:, :-1]], axis=-1)
+
+
+# Write a synthetic L2 granule: ascending swath geometry with pixel corners, the product variable and its precision, qa_value
+# (about 80% of the pixels above the validity threshold), time variables and the time_coverage_* attributes
+def write_granule(path, product, start_time, orbit, scanlines, ground_pixels, track_longitude, rng):
+    variable, units, mean, deviation = l2_variables[product]
+    along = np.arange(scanlines)[:, None]
+    across = np.linspace(-1, 1, ground_pixels)[None, :]
+    latitude = first_latitude + along * scanline_size + 0.5 * across ** 2
+    longitude = track_longitude - track_drift * (latitude - first_latitude) + swath_half_width * (across + 0.3 * across ** 3) / 1.3
+    latitude, longitude = np.broadcast_to(latitude, (scanlines, ground_pixels)), np.broadcast_to(longitude, (scanlines, ground_pixels))
+    values = rng.normal(mean, deviation, (scanlines, ground_pixels)).astype('float32')
+    qa_value = np.clip(rng.normal(0.85, 0.15, (scanlines, ground_pixels)), 0, 1)
+    delta_time = (along[:, 0] * 840).astype('int32')    # 0.84 s per scanline (milliseconds)
+    end_time = start_time + timedelta(milliseconds=int(delta_time[-1]))
+    day_start = datetime(start_time.year, start_time.month, start_time.day)
+
+    with netCDF4.Dataset(path, 'w') as dataset:
+        dataset.setncatts({
+            'time_coverage_start': f'{start_time:%Y-%m-%dT%H:%M:%S}Z', 'time_coverage_end': f'{end_time:%Y-%m-%dT%H:%M:%S}Z',
+            'orbit': orbit, 'processor_version': '2.5.0', 'product_version': '2.5.0', 'Conventions': 'CF-1.7',
+            'title': f'TROPOMI/S5P {product} L2 (synthetic benchmark granule)'
+        })
+        dataset.createGroup('METADATA').createGroup('GRANULE_DESCRIPTION').setncatts({'ProductShortName': f'L2__{product:_<6}', 'ProcessingMode': 'Offline'})
+        group = dataset.createGroup('PRODUCT')
+        group.createDimension('time', 1)
+        group.createDimension('scanline', scanlines)
+        group.createDimension('ground_pixel', ground_pixels)
+        group.createDimension('corner', 4)
+        group.createVariable('time', 'i4', ('time',))[:] = int((day_start - time_reference).total_seconds())
+        group['time'].units = 'seconds since 2010-01-01 00:00:00'
+        group.createVariable('delta_time', 'i4', ('time', 'scanline'))[0] = delta_time + int((start_time - day_start).total_seconds() * 1000)
+        group['delta_time'].units = 'milliseconds since ' + f'{day_start:%Y-%m-%d %H:%M:%S}'
+        group.createVariable('latitude', 'f4', ('time', 'scanline', 'ground_pixel'))[0] = latitude
+        group.createVariable('longitude', 'f4', ('time', 'scanline', 'ground_pixel'))[0] = longitude
+        group['latitude'].units, group['longitude'].units = 'degrees_north', 'degrees_east'
+        group.createVariable('qa_value', 'u1', ('time', 'scanline', 'ground_pixel'))
+        group['qa_value'].setncatts({'scale_factor': np.float32(0.01), 'add_offset': np.float32(0)})
+        group['qa_value'][0] = qa_value
+        for name, data in [(variable, values), (variable + '_precision', np.abs(values) * 0.1 + deviation * 0.1)]:
+            group.createVariable(name, 'f4', ('time', 'scanline', 'ground_pixel'), fill_value=np.float32(9.96921e36), zlib=True, complevel=1)[0] = data
+            group[name].units = units
+
+        geolocations = group.createGroup('SUPPORT_DATA').createGroup('GEOLOCATIONS')
+        geolocations.createVariable('latitude_bounds', 'f4', ('time', 'scanline', 'ground_pixel', 'corner'), zlib=True, complevel=1)[0] = pixel_corners(latitude)
+        geolocations.createVariable('longitude_bounds', 'f4', ('time', 'scanline', 'ground_pixel', 'corner'), zlib=True, complevel=1)[0] = pixel_corners(longitude)
+        for name, angle in [('solar_zenith_angle', 30 + 0.5 * latitude), ('viewing_zenith_angle', 66 * np.abs(across) + 0 * latitude),
+                            ('solar_azimuth_angle', 0 * latitude + 120), ('viewing_azimuth_angle', np.where(across < 0, 100, -80) + 0 * latitude)]:
+            geolocations.createVariable(name, 'f4', ('time', 'scanline', 'ground_pixel'), zlib=True, complevel=1)[0] = angle
+        input_data = group['SUPPORT_DATA'].createGroup('INPUT_DATA')
+        input_data.createVariable('surface_pressure', 'f4', ('time', 'scanline', 'ground_pixel'), zlib=True, complevel=1)[0] = 101325 - 20 * np.abs(latitude)
+        input_data.createVariable('surface_altitude', 'f4', ('time', 'scanline', 'ground_pixel'), zlib=True, complevel=1)[0] = rng.uniform(0, 500, (scanlines, ground_pixels))
+
+
+# Generate the synthetic granules of all products, spread over the given number of days before today (one ascending overpass
+# per granule at about 06:00 UTC, the ground track of each overpass shifted by a random offset)
+def generate_granules(directory, granules, days, scanlines, ground_pixels, seed):
+    rng = np.random.default_rng(seed)
+    today = datetime.combine(datetime.now().date(), datetime.min.time())
+    files = []
+    for product_index, product in enumerate(l2_variables):
+        for granule in range(granules):
+            start_time = today - timedelta(days=1 + granule % days, hours=18, minutes=granule // days * 100)
+            orbit = 30000 + product_index * 1000 + granule
+            path = os.path.join(directory, granule_name(product, start_time, start_time + timedelta(hours=1), orbit))
+            write_granule(path, product, start_time, orbit, scanlines, ground_pixels, 102.5 + rng.uniform(-6, 6), rng)
+            files.append(path)
+    return files
+
+
+# Import a synthetic granule as HARP product in place of the HARP S5P ingestion (harp.import_product), which also reads the many
+# fields of the L2 products that the workflow does not use. The pixels are flattened to the time dimension like the S5P ingestion
+# does, with the variables used by the conversion (product variable, validity, pixel centres and corners, sensing time), and the
+# import operations are applied by HARP, so the filtering and binning of process.convert_product are measured as in the workflow
+def import_granule(file, operations=''):
+    product = process.file_product(file)
+    variable, units = l2_variables[product][:2]
+    with netCDF4.Dataset(file) as dataset:
+        group = dataset['PRODUCT']
+        geolocations = group['SUPPORT_DATA/GEOLOCATIONS']
+        ground_pixels = group.dimensions['ground_pixel'].size
+        sensing_time = int(group['time'][0]) + np.repeat(np.asarray(group['delta_time'][0], dtype='float64') / 1000, ground_pixels)
+        harp_product = harp.Product()
+        harp_product.datetime_start = harp.Variable(sensing_time, ['time'], unit='s since 2010-01-01')
+        harp_product.datetime_length = harp.Variable(np.full(sensing_time.size, 0.84), ['time'], unit='s')
+        harp_product.latitude = harp.Variable(group['latitude'][0].filled(np.nan).ravel().astype('float64'), ['time'], unit='degree_north')
+        harp_product.longitude = harp.Variable(group['longitude'][0].filled(np.nan).ravel().astype('float64'), ['time'], unit='degree_east')
+        harp_product.latitude_bounds = harp.Variable(np.asarray(geolocations['latitude_bounds'][0], dtype='float64').reshape(-1, 4), ['time', None], unit='degree_north')
+        harp_product.longitude_bounds = harp.Variable(np.asarray(geolocations['longitude_bounds'][0], dtype='float64').reshape(-1, 4), ['time', None], unit='degree_east')
+        harp_product[aggregate.product_attributes[product][0]] = harp.Variable(group[variable][0].filled(np.nan).ravel().astype('float64'), ['time'],
+                                                                              unit=harp_units[units])
+        harp_product[process.product_conversion[product][0]] = harp.Variable(np.rint(group['qa_value'][0].filled(0).ravel() * 100).astype('int32'), ['time'])
+    return harp.execute_operations(harp_product, operations)
+
+
+# Initialize a conversion worker: limit its memory like process.py and import the synthetic granules with import_granule
+def init_conversion_worker(memory_limit):
+    process.limit_worker_memory(memory_limit)
+    harp.import_product = import_granule
+
+
+# Convert the granules to L3 with the worker pool of process.py (importing them with import_granule) and record the L3 files in
+# the catalog. If no granule is converted, the conversion is not measured and an error is raised
+def benchmark_convert(files):
+    catalog.sync()
+    start_time = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=process.num_workers, initializer=init_conversion_worker, initargs=(process.worker_memory_limit,)) as executor:
+        futures = [executor.submit(process.convert_product, file, process.file_product(file), process.missing_regions(file)) for file in files]
+        results = [future.result() for future in as_completed(futures)]
+    seconds = time.perf_counter() - start_time
+    for result in results:
+        process.record_conversion(result)
+        if result['error'] is not None:
+            print(f'Error converting {os.path.basename(result["file"])}: {result["error"]}')
+    converted = [result for result in results if result['error'] is None]
+    if not converted:
+        raise RuntimeError(f'no granule was converted ({len(results)} failed)')
+    return {
+        'convert_seconds': seconds, 'convert_files': len(converted), 'convert_failed': len(results) - len(converted),
+        'convert_files_per_second': len(converted) / seconds, 'convert_l2_megabytes_per_second': sum(os.path.getsize(file) for file in files) / seconds / 2 ** 20,
+        'l3_megabytes': sum(result['bytes_written'] for result in converted) / 2 ** 20
+    }
+
+
+# Add the L3 files of all products to the daily aggregates of every region
+def benchmark_aggregate():
+    start_time = time.perf_counter()
+    for region in regions.regions:
+        aggregate.update_region(region, 'benchmark')
+    return {'aggregate_seconds': time.perf_counter() - start_time}
+
+
+# Calculate the mean of every product and region over the days of the granules
+def benchmark_means(start_date, end_date):
+    start_time = time.perf_counter()
+    means = {}
+    for region in regions.regions:
+        for product, attributes in aggregate.product_attributes.items():
+            mean = aggregate.period_mean(region, product, start_date, end_date, attributes[0])
+            if mean is not None:
+                means[(region, product)] = mean
+    return {'mean_seconds': time.perf_counter() - start_time}, means
+
+
+# Render the PNG of every mean and the JPG of all products of every region with the render pool of multitemporal.py. The basemap
+# is left empty if the Natural Earth data is neither cached nor downloadable (offline), its preparation is timed separately
+def benchmark_render(means, period):
+    timings = {'basemap_seconds': 0}
+    png_paths_by_region = {}
+    start_time = time.perf_counter()
+    for region_name, region in regions.regions.items():
+        basemap_start_time = time.perf_counter()
+        try:
+            basemap = render.prepare_basemap(region['extent'])
+        except Exception as error:
+            print(f'Error: {error}. Rendering without basemap.')
+            basemap = {layer: [] for layer in render.basemap_layers}
+        timings['basemap_seconds'] += time.perf_counter() - basemap_start_time
+        scalebar_latitude = (region['extent'][2] + region['extent'][3]) / 2
+        img_output_dir = f'{region["output_dir"]}{period[1]:%Y_%m_%d}'
+        os.makedirs(img_output_dir, exist_ok=True)
+        product_means = {product: mean for (mean_region, product), mean in means.items() if mean_region == region_name}
+        with ProcessPoolExecutor(max_workers=render.num_render_workers) as executor:
+            futures = []
+            for product, mean in product_means.items():
+                png_path = f'{img_output_dir}/{product}_{period[0]:%Y_%m_%d}-{period[1]:%Y_%m_%d}.png'
+                futures.append(executor.submit(render.render_product_png, png_path, region_name, region['extent'], basemap, scalebar_latitude,
+                                               product, mean, period, aggregate.product_attributes[product]))
+            futures.append(executor.submit(render.render_all_products_jpg, f'{region["output_dir"]}all_products.jpg', region_name, region['extent'],
+                                           basemap, scalebar_latitude, product_means, {product: period for product in product_means}, aggregate.product_attributes))
+            png_paths_by_region[region['output_dir']] = [future.result() for future in futures[:-1]]
+            futures[-1].result()
+    timings['render_seconds'] = time.perf_counter() - start_time - timings['basemap_seconds']
+    timings['render_outputs'] = sum(len(png_paths) + 1 for png_paths in png_paths_by_region.values())
+    return timings, png_paths_by_region
+
+
+# Copy the rendered PNGs of every region into the dated output directories of the previous weeks, so every animation has
+# the full number of frames
+def prepare_animation_frames(png_paths_by_region, frames):
+    for output_dir, png_paths in png_paths_by_region.items():
+        for week in range(1, frames):
+            for png_path in png_paths:
+                product, dates = os.path.basename(png_path)[:-4].split('_', 1)
+                start_date, end_date = (datetime.strptime(date, '%Y_%m_%d') - timedelta(weeks=week) for date in dates.split('-'))
+                os.makedirs(f'{output_dir}{end_date:%Y_%m_%d}', exist_ok=True)
+                shutil.copyfile(png_path, f'{output_dir}{end_date:%Y_%m_%d}/{product}_{start_date:%Y_%m_%d}-{end_date:%Y_%m_%d}.png')
+
+
+# Animate the PNG outputs of every product and region
+def benchmark_animation(png_paths_by_region):
+    prepare_animation_frames(png_paths_by_region, animate.animation_frames)
+    start_time = time.perf_counter()
+    animations = 0
+    for output_dir, png_paths in png_paths_by_region.items():
+        for png_path in png_paths:
+            animate.animate_product(output_dir, os.path.basename(png_path).split('_', 1)[0])
+            animations += 1
+    return {'animation_seconds': time.perf_counter() - start_time, 'animations': animations}
+
+
+# Return the commit of the working tree (with a suffix if it has uncommitted changes), None outside of a git repository
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('-dirty' if dirty else '')
+
+
+# Return the latest previous result with the same configuration, None if there is none
+def previous_result(configuration):
+    if not os.path.exists(results_path):
+        return None
+    previous = None
+    with open(results_path) as file:
+        for line in file:
+            result = json.loads(line)
+            if result['configuration'] == configuration:
+                previous = result
+    return previous
+
+
+# Print the timings of a run next to the previous run with the same configuration and return the stages that regressed
+def print_comparison(result, previous):
+    regressions = []
+    print(f'\nBenchmark results ({result["commit"]}' + (f', compared to {previous["commit"]} of {previous["time"]})' if previous else ')'))
+    for name, value in result['timings'].items():
+        line = f'  {name:34} {value:12.3f}'
+        if previous and name in previous['timings']:
+            previous_value = previous['timings'][name]
+            line += f' {previous_value:12.3f}'
+            if name.endswith('_seconds') and previous_value > 0:
+                change = value / previous_value - 1
+                line += f' {change:+8.1%}'
+                if change > regression_threshold and value > regression_min_seconds:
+                    line += '  REGRESSION'
+                    regressions.append(name)
+        print(line)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the stages of the workflow with synthetic Sentinel-5P L2 granules.')
+    parser.add_argument('--granules', type=int, default=4, help='number of granules per product (default: 4)')
+    parser.add_argument('--days', type=int, default=7, help='number of days the granules are spread over (default: 7)')
+    parser.add_argument('--scanlines', type=int, default=600, help='number of scanlines per granule (default: 600)')
+    parser.add_argument('--ground-pixels', type=int, default=450, help='number of ground pixels per scanline (default: 450)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic values')
+    parser.add_argument('--fail-on-regression', action='store_true', help='exit with a non-zero exit code if a stage regressed')
+    arguments = parser.parse_args()
+    configuration = {'granules': arguments.granules, 'days': arguments.days, 'scanlines': arguments.scanlines, 'ground_pixels': arguments.ground_pixels,
+                     'seed': arguments.seed, 'version': benchmark_version}
+
+    # Set up an empty working directory containing the support files only, the stages use their usual relative paths inside it
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    os.chdir(repo_dir)
+    commit = git_commit()
+    shutil.rmtree(benchmark_dir, ignore_errors=True)
+    os.makedirs(benchmark_dir + 'Products_Raw/')
+    shutil.copytree('Support_Files', benchmark_dir + 'Support_Files')
+    os.chdir(benchmark_dir)
+
+    # Run the stages one after another, a failing stage ends the benchmark (its timings and the error are still saved)
+    timings = {}
+    error = None
+    start_time = time.perf_counter()
+    try:
+        print(f'Generating {arguments.granules} granules of each product...')
+        files = generate_granules('Products_Raw/', arguments.granules, arguments.days, arguments.scanlines, arguments.ground_pixels, arguments.seed)
+        timings['generate_seconds'] = time.perf_counter() - start_time
+        timings['l2_megabytes'] = sum(os.path.getsize(file) for file in files) / 2 ** 20
+        print('Converting...')
+        timings.update(benchmark_convert(files))
+        print('Aggregating...')
+        timings.update(benchmark_aggregate())
+        period = (datetime.now() - timedelta(days=arguments.days + 1), datetime.now())
+        print('Averaging...')
+        mean_timings, means = benchmark_means(*period)
+        timings.update(mean_timings)
+        print('Rendering...')
+        render_timings, png_paths_by_region = benchmark_render(means, period)
+        timings.update(render_timings)
+        print('Animating...')
+        timings.update(benchmark_animation(png_paths_by_region))
+    except Exception as exception:
+        error = f'{type(exception).__name__}: {exception}'
+        print(f'Error: {error}')
+    timings['total_seconds'] = time.perf_counter() - start_time
+
+    # Save the results and compare them to the previous run with the same configuration
+    os.chdir(repo_dir)
+    result = {
+        'time': datetime.now().isoformat(timespec='seconds'), 'commit': commit, 'host': platform.node(), 'cpu_count': os.cpu_count(),
+        'python': platform.python_version(), 'numpy': np.__version__, 'configuration': configuration,
+        'timings': {name: round(value, 4) for name, value in timings.items()}, 'error': error
+    }
+    previous = previous_result(configuration)
+    os.makedirs(os.path.dirname(results_path), exist_ok=True)
+    with open(results_path, 'a') as file:
+        file.write(json.dumps(result) + '\n')
+    regressions = print_comparison(result, previous)
+    print(f'Saved: {results_path}')
+    if error or (regressions and arguments.fail_on_regression):
+        raise SystemExit(1)
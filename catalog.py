@@ -0,0 +1,311 @@
+import os
+import sqlite3
+from contextlib import closing
+from datetime import datetime, timedelta
+
+import regions
+
+# Persistent catalog (SQLite) of the products handled by the stages. Every stage queries and updates the catalog instead of
+# scanning the product directories and parsing file names. Usage: python catalog.py prints what is missing for the last week
+
+# Define the path of the catalog database
+catalog_path = 'catalog.sqlite'
+
+# Define the directories of the raw (L2) and processed (L3) files (one sub-directory per region)
+raw_dir = 'Products_Raw/'
+processed_dir = 'Products_Processed/'
+
+# Define the products that are only available as offline products
+offl_only_products = ['CH4']
+
+# Define the condition selecting products superseded by a better version of the same orbit: an offline (OFFL) product
+# supersedes the near-real-time (NRTI) products of its orbit, a newer processor version supersedes older versions of the same mode.
+# {rival_condition} restricts the products that count as better version (e.g. only converted products)
+superseded_condition = '''
+    EXISTS (
+        SELECT 1 FROM products AS rival
+        WHERE rival.product = products.product AND rival.orbit = products.orbit AND rival.state != 'expired'
+        AND ((rival.mode = 'OFFL' AND products.mode != 'OFFL') OR (rival.mode = products.mode AND rival.processor_version > products.processor_version))
+        {rival_condition}
+    )
+'''
+
+# Define the conditions on the better version: converted for any region, downloaded or converted, converted for the region (parameter)
+converted_rival = 'AND EXISTS (SELECT 1 FROM l3_files WHERE l3_files.identifier = rival.identifier AND l3_files.path IS NOT NULL)'
+available_rival = 'AND (rival.raw_path IS NOT NULL OR EXISTS (SELECT 1 FROM l3_files WHERE l3_files.identifier = rival.identifier AND l3_files.path IS NOT NULL))'
+region_rival = 'AND EXISTS (SELECT 1 FROM l3_files WHERE l3_files.identifier = rival.identifier AND l3_files.region = ? AND l3_files.path IS NOT NULL)'
+
+# Define the tables of the catalog
+schema = '''
+    CREATE TABLE IF NOT EXISTS products (
+        identifier TEXT PRIMARY KEY,    -- L2 file name without extension
+        uuid TEXT,
+        product TEXT,                   -- e.g. NO2
+        mode TEXT,                      -- NRTI or OFFL
+        orbit INTEGER,
+        processor_version TEXT,
+        sensing_start TEXT,             -- ISO format
+        sensing_end TEXT,
+        sensing_day TEXT,               -- YYYYMMDD
+        raw_path TEXT,                  -- path of the downloaded L2 file, NULL if not downloaded or deleted
+        state TEXT                      -- queried, downloaded, converted, aggregated, superseded or expired
+    );
+    CREATE INDEX IF NOT EXISTS products_product_day ON products (product, sensing_day);
+    CREATE INDEX IF NOT EXISTS products_product_orbit ON products (product, orbit);
+    CREATE TABLE IF NOT EXISTS l3_files (
+        identifier TEXT,
+        region TEXT,
+        path TEXT,
+        aggregated INTEGER DEFAULT 0,
+        empty INTEGER DEFAULT 0,        -- 1: converted, but the product has no valid cells inside the region (no L3 file)
+        PRIMARY KEY (identifier, region)
+    );
+'''
+
+
+# Open the catalog, creating its tables if necessary
+def connect():
+    connection = sqlite3.connect(catalog_path, timeout=60)
+    connection.row_factory = sqlite3.Row
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.executescript(schema)
+    if 'empty' not in {row['name'] for row in connection.execute('PRAGMA table_info(l3_files)')}:
+        connection.execute('ALTER TABLE l3_files ADD COLUMN empty INTEGER DEFAULT 0')     # catalog created before empty regions were recorded
+    return connection
+
+
+# Parse the fields of a product from its identifier (e.g. S5P_NRTI_L2__NO2____20231001T050000_20231001T060000_30000_03_020500_20231001T070000)
+def parse_identifier(identifier):
+    return {
+        'identifier': identifier,
+        'product': identifier[13:19].rstrip('_'),
+        'mode': identifier[4:8],
+        'orbit': int(identifier[52:57]),
+        'processor_version': identifier[61:67],
+        'sensing_start': datetime.strptime(identifier[20:35], '%Y%m%dT%H%M%S').isoformat(),
+        'sensing_end': datetime.strptime(identifier[36:51], '%Y%m%dT%H%M%S').isoformat(),
+        'sensing_day': identifier[20:28],
+    }
+
+
+# Return the identifier of an L2 or L3 file
+def file_identifier(path):
+    return os.path.basename(path)[:-3].replace('L3', 'L2')
+
+
+# Return the time period (start and end date) of the mean of a product up to a date: the last week, or the week before for the
+# offline only products (available within about 5 days after sensing). Shared by the render, export and zonal stages
+def mean_period(product, current_date):
+    if product in offl_only_products:
+        return current_date - timedelta(days=14), current_date - timedelta(days=7)
+    return current_date - timedelta(days=7), current_date
+
+
+# Add a product to the catalog if it is not part of it yet
+def register(connection, identifier, uuid=None):
+    fields = parse_identifier(identifier)
+    connection.execute(
+        'INSERT OR IGNORE INTO products (identifier, product, mode, orbit, processor_version, sensing_start, sensing_end, sensing_day, state) '
+        'VALUES (:identifier, :product, :mode, :orbit, :processor_version, :sensing_start, :sensing_end, :sensing_day, \'queried\')', fields)
+    if uuid is not None:
+        connection.execute('UPDATE products SET uuid = ? WHERE identifier = ?', (uuid, identifier))
+
+
+# Update the state of a product from its files: the furthest stage reached for every region (regions without valid cells count
+# as converted and aggregated), or superseded once a better version of its orbit is converted
+def refresh_state(connection, identifier):
+    raw_path = connection.execute('SELECT raw_path FROM products WHERE identifier = ?', (identifier,)).fetchone()['raw_path']
+    l3_rows = connection.execute('SELECT aggregated OR empty AS aggregated FROM l3_files WHERE identifier = ? AND (path IS NOT NULL OR empty)', (identifier,)).fetchall()
+    superseded = connection.execute(
+        'SELECT 1 FROM products WHERE identifier = ? AND ' + superseded_condition.format(rival_condition=converted_rival), (identifier,)).fetchone()
+    if superseded:
+        state = 'superseded'
+    elif len(l3_rows) >= len(regions.regions):
+        state = 'aggregated' if all(row['aggregated'] for row in l3_rows) else 'converted'
+    elif raw_path is not None:
+        state = 'downloaded'
+    else:
+        state = 'queried'
+    connection.execute('UPDATE products SET state = ? WHERE identifier = ? AND state != \'expired\'', (state, identifier))
+
+
+# Add the products of a query to the catalog
+def register_query(products):
+    with closing(connect()) as connection, connection:
+        for uuid, properties in products.items():
+            register(connection, properties['identifier'], uuid)
+
+
+# Record the downloaded L2 file of a product (path None: the file was deleted)
+def set_raw_path(identifier, path):
+    with closing(connect()) as connection, connection:
+        register(connection, identifier)
+        connection.execute('UPDATE products SET raw_path = ? WHERE identifier = ?', (path, identifier))
+        refresh_state(connection, identifier)
+
+
+# Record the L3 file of a product for a region (path None: the file was deleted) and update the state of all versions of its orbit
+def set_l3_path(identifier, region, path):
+    with closing(connect()) as connection, connection:
+        register(connection, identifier)
+        connection.execute('INSERT OR REPLACE INTO l3_files (identifier, region, path, aggregated) VALUES (?, ?, ?, 0)', (identifier, region, path))
+        for row in connection.execute(
+                'SELECT identifier FROM products WHERE (product, orbit) = (SELECT product, orbit FROM products WHERE identifier = ?)', (identifier,)).fetchall():
+            refresh_state(connection, row['identifier'])
+
+
+# Record that a product has no valid cells inside a region, so it is not converted for the region again
+def set_l3_empty(identifier, region):
+    with closing(connect()) as connection, connection:
+        register(connection, identifier)
+        connection.execute('INSERT OR REPLACE INTO l3_files (identifier, region, path, aggregated, empty) VALUES (?, ?, NULL, 0, 1)', (identifier, region))
+        refresh_state(connection, identifier)
+
+
+# Record that L3 files of a region were added to the daily aggregates
+def set_aggregated(region, paths):
+    with closing(connect()) as connection, connection:
+        for path in paths:
+            for row in connection.execute('SELECT identifier FROM l3_files WHERE region = ? AND path = ?', (region, path)).fetchall():
+                connection.execute('UPDATE l3_files SET aggregated = 1 WHERE identifier = ? AND region = ?', (row['identifier'], region))
+                refresh_state(connection, row['identifier'])
+
+
+# Record that the files of products were deleted because they are older than the retention time-frame
+def set_expired(identifiers):
+    with closing(connect()) as connection, connection:
+        for identifier in identifiers:
+            connection.execute('UPDATE products SET state = \'expired\' WHERE identifier = ?', (identifier,))
+
+
+# Add the conditions selecting products and their sensing day to a catalog query
+def product_conditions(query, parameters, products, excluded_products, sensed_before):
+    if products is not None:
+        query += f' AND product IN ({",".join("?" * len(products))})'
+        parameters += list(products)
+    if excluded_products is not None:
+        query += f' AND product NOT IN ({",".join("?" * len(excluded_products))})'
+        parameters += list(excluded_products)
+    if sensed_before is not None:
+        query += ' AND sensing_day < ?'
+        parameters.append(sensed_before.strftime('%Y%m%d'))
+    return query + ' ORDER BY identifier', parameters
+
+
+# Return the downloaded L2 files, optionally only of the given products, not of the excluded products and sensed before the day of a date
+def raw_files(products=None, excluded_products=None, sensed_before=None):
+    query, parameters = product_conditions('SELECT raw_path FROM products WHERE raw_path IS NOT NULL', [], products, excluded_products, sensed_before)
+    with closing(connect()) as connection:
+        return [row['raw_path'] for row in connection.execute(query, parameters)]
+
+
+# Return the sensing day (YYYYMMDD) of the products in the catalog, optionally only of the given products, by identifier
+def sensing_days(products=None):
+    query, parameters = product_conditions('SELECT identifier, sensing_day FROM products WHERE 1', [], products, None, None)
+    with closing(connect()) as connection:
+        return {row['identifier']: row['sensing_day'] for row in connection.execute(query, parameters)}
+
+
+# Return the L3 files of a region, optionally only of the given products, not of the excluded products and sensed before the day of a date
+def l3_files(region, products=None, excluded_products=None, sensed_before=None):
+    query, parameters = product_conditions(
+        'SELECT l3_files.path FROM l3_files JOIN products USING (identifier) WHERE region = ? AND path IS NOT NULL', [region],
+        products, excluded_products, sensed_before)
+    with closing(connect()) as connection:
+        return [row['path'] for row in connection.execute(query, parameters)]
+
+
+# Return the regions a product has not been converted to L3 for yet (regions without valid cells count as converted). Products
+# superseded by a downloaded or converted better version of their orbit are not converted
+def missing_regions(identifier):
+    with closing(connect()) as connection:
+        superseded = connection.execute(
+            'SELECT 1 FROM products WHERE identifier = ? AND ' + superseded_condition.format(rival_condition=available_rival), (identifier,)).fetchone()
+        if superseded:
+            return []
+        converted = {row['region'] for row in connection.execute('SELECT region FROM l3_files WHERE identifier = ? AND (path IS NOT NULL OR empty)', (identifier,))}
+    return [region for region in regions.regions if region not in converted]
+
+
+# Return the identifiers of the products that are already downloaded, already converted to L3 for every region or superseded
+# by a better version of their orbit (e.g. an NRTI product whose OFFL product is part of the query)
+def skip_list():
+    with closing(connect()) as connection:
+        downloaded = {row['identifier'] for row in connection.execute('SELECT identifier FROM products WHERE raw_path IS NOT NULL')}
+        converted = {
+            row['identifier'] for row in connection.execute(
+                'SELECT identifier FROM l3_files WHERE path IS NOT NULL OR empty GROUP BY identifier HAVING COUNT(*) >= ?', (len(regions.regions),))
+        }
+        superseded = {
+            row['identifier'] for row in connection.execute('SELECT identifier FROM products WHERE ' + superseded_condition.format(rival_condition=''))
+        }
+    return downloaded | converted | superseded
+
+
+# Return the L3 files of a region (including deleted files) whose contribution to the daily aggregates is replaced by the
+# converted L3 file of a better version of their orbit
+def superseded_l3_files(region, products=None):
+    query, parameters = product_conditions(
+        'SELECT identifier, l3_files.path FROM l3_files JOIN products USING (identifier) WHERE region = ? AND ' +
+        superseded_condition.format(rival_condition=region_rival), [region, region], products, None, None)
+    with closing(connect()) as connection:
+        return [row['path'] or os.path.join(processed_dir, region, row['identifier'].replace('L2', 'L3') + '.nc') for row in connection.execute(query, parameters)]
+
+
+# Bring the catalog in line with the product directories (e.g. for files added or deleted outside of the stages, or for an
+# existing installation without catalog). Each directory is scanned once
+def sync():
+    with closing(connect()) as connection, connection:
+        raw_names = {filename for filename in os.listdir(raw_dir) if filename.endswith('.nc')} if os.path.isdir(raw_dir) else set()
+        for filename in raw_names:
+            try:
+                register(connection, filename[:-3])
+            except ValueError:
+                continue    # not a Sentinel-5P product file
+            connection.execute('UPDATE products SET raw_path = ? WHERE identifier = ?', (raw_dir + filename, filename[:-3]))
+        for row in connection.execute('SELECT identifier, raw_path FROM products WHERE raw_path IS NOT NULL').fetchall():
+            if os.path.basename(row['raw_path']) not in raw_names:
+                connection.execute('UPDATE products SET raw_path = NULL WHERE identifier = ?', (row['identifier'],))
+
+        for region in regions.regions:
+            region_dir = processed_dir + region + '/'
+            l3_names = {filename for filename in os.listdir(region_dir) if filename.endswith('.nc')} if os.path.isdir(region_dir) else set()
+            known = {row['path'] for row in connection.execute('SELECT path FROM l3_files WHERE region = ? AND path IS NOT NULL', (region,))}
+            for filename in l3_names:
+                if region_dir + filename not in known:
+                    try:
+                        register(connection, file_identifier(filename))
+                    except ValueError:
+                        continue
+                    connection.execute('INSERT OR REPLACE INTO l3_files (identifier, region, path, aggregated) VALUES (?, ?, ?, 0)',
+                                       (file_identifier(filename), region, region_dir + filename))
+            for path in known:
+                if os.path.basename(path) not in l3_names:
+                    connection.execute('UPDATE l3_files SET path = NULL WHERE region = ? AND path = ?', (region, path))
+
+        for row in connection.execute('SELECT identifier FROM products WHERE state != \'expired\'').fetchall():
+            refresh_state(connection, row['identifier'])
+
+
+# Print the number of products of the last week in each state and the products that are not converted or aggregated yet
+def print_week_status():
+    current_date = datetime.now()
+    with closing(connect()) as connection:
+        products = [row['product'] for row in connection.execute('SELECT DISTINCT product FROM products ORDER BY product')]
+        for product in products:
+            start_date, end_date = mean_period(product, current_date)
+            rows = connection.execute(
+                'SELECT identifier, state FROM products WHERE product = ? AND sensing_day BETWEEN ? AND ? ORDER BY identifier',
+                (product, start_date.strftime('%Y%m%d'), end_date.strftime('%Y%m%d'))).fetchall()
+            states = {}
+            for row in rows:
+                states[row['state']] = states.get(row['state'], 0) + 1
+            print(f'{product} {start_date.date()} – {end_date.date()}: {len(rows)} products ' + ', '.join(f'{count} {state}' for state, count in sorted(states.items())))
+            for row in rows:
+                if row['state'] in ('queried', 'downloaded', 'converted'):
+                    print(f'  {row["identifier"]}: {row["state"]}')
+
+
+if __name__ == '__main__':
+    sync()
+    print_week_status()
@@ -0,0 +1,190 @@
+import os
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import xarray as xr
+
+import aggregate
+import metrics
+import regions
+
+# Long-term baseline of every product, updated incrementally from the daily aggregates. For every region, product and calendar
+# month the running sum, sum of squares and number of the daily means of each cell are kept, so the daily aggregates (and the
+# L3 files) can be deleted after eight weeks while the baseline keeps growing at the cost of three grids per month
+
+# Define directory to store the climatology in (one sub-directory per region and product, one NetCDF file per calendar month)
+climatology_dir = 'Products_Climatology/'
+
+# Define the time after which a daily aggregate is complete and added to the climatology (late-arriving and OFFL products of a
+# day are downloaded for up to two weeks, see query.py). It must be shorter than the retention time of the daily aggregates
+settle_time = timedelta(days=14)
+
+# Define the baseline an anomaly is calculated against: 'month' (calendar month of the time period) or 'season' (its three
+# month meteorological season, e.g. December to February)
+baseline_period = 'month'
+
+# Define the calendar months of each meteorological season
+season_months = [[12, 1, 2], [3, 4, 5], [6, 7, 8], [9, 10, 11]]
+
+# Define the minimum number of daily means of a cell in the baseline. Cells with fewer days have no anomaly
+min_baseline_days = 10
+
+
+# Return the path of the climatology file of a product and calendar month
+def climatology_path(region, product, month):
+    return os.path.join(climatology_dir, region, product, f'{product}_{month:02d}.nc')
+
+
+# Read the climatology of a product and calendar month (running sum, sum of squares and number of daily means per cell, and
+# the days it contains). Returns None and no days if the month has no climatology yet
+def read_climatology(region, product, month):
+    path = climatology_path(region, product, month)
+    if not os.path.exists(path):
+        return None, set()
+    with xr.open_dataset(path) as ds:
+        ds.load()
+    return ds, set(ds.attrs['days'].split()) if ds.attrs.get('days') else set()
+
+
+# Write the climatology of a product and calendar month. The sums are stored as float64, as the variance is calculated from the
+# difference of the sum of squares and the squared mean. The file is written under a temporary name and renamed once complete
+def write_climatology(region, product, month, grid_sum, grid_sum_squares, grid_count, latitude, longitude, days):
+    ds = xr.Dataset(
+        {
+            'sum': (('latitude', 'longitude'), grid_sum),
+            'sum_squares': (('latitude', 'longitude'), grid_sum_squares),
+            'count': (('latitude', 'longitude'), grid_count.astype('int32')),
+        },
+        coords={'latitude': latitude, 'longitude': longitude},
+        attrs={'region': region, 'product': product, 'month': month, 'days': ' '.join(sorted(days))}
+    )
+    path = climatology_path(region, product, month)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    ds.to_netcdf(path + '.part')
+    os.replace(path + '.part', path)
+
+
+# Add the complete daily aggregates of a product that are not yet part of its climatology. Every day is added once to the
+# climatology of its calendar month, only the daily aggregates of the new days are read. Days aggregated on a different grid
+# than the climatology (grid cell size changed) are left out. Returns the number of days added
+def update_climatology(region, product):
+    settled_date = datetime.now() - settle_time
+    days_by_month = {}
+    for day in aggregate.period_days(region, product, datetime.min, settled_date):
+        days_by_month.setdefault(int(day[4:6]), []).append(day)
+
+    days_added = 0
+    for month, month_days in sorted(days_by_month.items()):
+        ds, included_days = read_climatology(region, product, month)
+        new_days = [day for day in month_days if day not in included_days]
+        if not new_days:
+            continue
+        if ds is not None:
+            grid_sum, grid_sum_squares = ds['sum'].values.astype('float64'), ds['sum_squares'].values.astype('float64')
+            grid_count = ds['count'].values.astype('int32')
+            latitude, longitude = ds['latitude'].values, ds['longitude'].values
+        else:
+            grid_sum = grid_sum_squares = grid_count = latitude = longitude = None
+        added = []
+        for day in new_days:
+            daily, _ = aggregate.read_daily(region, product, day)
+            if grid_sum is None:
+                latitude, longitude = daily['latitude'].values, daily['longitude'].values
+                grid_sum = np.zeros((latitude.size, longitude.size), dtype='float64')
+                grid_sum_squares = np.zeros(grid_sum.shape, dtype='float64')
+                grid_count = np.zeros(grid_sum.shape, dtype='int32')
+            elif daily['sum'].shape != grid_sum.shape:
+                print(f'Error: {region} {product} {day} was aggregated on a different grid than the climatology. Skipping {day}.')
+                continue
+            daily_count = daily['count'].values
+            valid = daily_count > 0
+            daily_mean = daily['sum'].values[valid].astype('float64') / daily_count[valid]
+            grid_sum[valid] += daily_mean
+            grid_sum_squares[valid] += daily_mean ** 2
+            grid_count += valid
+            added.append(day)
+        if added:
+            write_climatology(region, product, month, grid_sum, grid_sum_squares, grid_count, latitude, longitude, included_days | set(added))
+            print(f'{region} {product}: added {len(added)} day(s) to the climatology of month {month:02d}')
+            days_added += len(added)
+    return days_added
+
+
+# Return the calendar months of the baseline of a date (its month or its season, see baseline_period)
+def baseline_months(date):
+    if baseline_period == 'season':
+        return next(months for months in season_months if date.month in months)
+    return [date.month]
+
+
+# Calculate the baseline mean and standard deviation of the daily means of a product for a date from the climatology of its
+# calendar months. Cells with fewer than min_baseline_days daily means are NaN. Returns None if no climatology is available
+def baseline(region, product, date):
+    grid_sum = grid_sum_squares = grid_count = None
+    for month in baseline_months(date):
+        ds, _ = read_climatology(region, product, month)
+        if ds is None:
+            continue
+        if grid_sum is None:
+            grid_sum, grid_sum_squares, grid_count = ds['sum'].values, ds['sum_squares'].values, ds['count'].values
+            latitude, longitude = ds['latitude'].values, ds['longitude'].values
+        elif ds['sum'].shape != grid_sum.shape:
+            print(f'Error: the {region} {product} climatology of month {month:02d} has a different grid. Skipping month {month:02d}.')
+            continue
+        else:
+            grid_sum, grid_sum_squares, grid_count = grid_sum + ds['sum'].values, grid_sum_squares + ds['sum_squares'].values, grid_count + ds['count'].values
+    if grid_sum is None:
+        return None
+    enough = grid_count >= min_baseline_days
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(enough, grid_sum / grid_count, np.nan)
+        std = np.sqrt(np.maximum(np.where(enough, grid_sum_squares / grid_count, np.nan) - mean ** 2, 0))
+    coords = {'latitude': latitude, 'longitude': longitude}
+    return xr.DataArray(mean, dims=('latitude', 'longitude'), coords=coords), xr.DataArray(std, dims=('latitude', 'longitude'), coords=coords)
+
+
+# Count the days with a valid daily mean of every cell in a time period. Days aggregated on a different grid than the mean are
+# left out, as in aggregate.period_mean. Only the numbers of observations of the daily aggregates are read
+def period_valid_days(region, product, start_date, end_date, shape):
+    valid_days = np.zeros(shape, dtype='int32')
+    for day in aggregate.period_days(region, product, start_date, end_date):
+        with xr.open_dataset(aggregate.daily_path(region, product, day)) as ds:
+            if ds['count'].shape == shape:
+                valid_days += ds['count'].values > 0
+    return valid_days
+
+
+# Calculate the anomaly of the mean of a product over a time period against the baseline of the middle of the time period:
+# the absolute difference and the z-score. The mean of n daily means varies less than a single day, so the difference is divided
+# by the standard deviation of the daily means of the baseline scaled to the number of valid days of the cell (std / sqrt(n),
+# assuming independent days). Returns None if no baseline is available or it has a different grid than the mean
+def anomaly(region, product, mean, period):
+    start_date, end_date = period
+    result = baseline(region, product, start_date + (end_date - start_date) / 2)
+    if result is None:
+        return None
+    baseline_mean, baseline_std = result
+    if baseline_mean.shape != mean.shape:
+        print(f'Error: the {region} {product} climatology has a different grid than the mean. No anomaly calculated.')
+        return None
+    difference = mean.values - baseline_mean.values
+    valid_days = period_valid_days(region, product, start_date, end_date, mean.shape)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        standard_error = baseline_std.values / np.sqrt(valid_days)
+        zscore = np.where((baseline_std.values > 0) & (valid_days > 0), difference / standard_error, np.nan)
+    return mean.copy(data=difference), mean.copy(data=zscore)
+
+
+# Add the complete daily aggregates of every region and product to the climatology
+# (python climatology.py, the climatology stage of execute.py)
+if __name__ == '__main__':
+    measurement = metrics.start_stage('climatology')
+    for region in regions.regions:
+        for product in aggregate.product_attributes:
+            start_time = time.perf_counter()
+            days_added = update_climatology(region, product)
+            metrics.record('climatology', 'climatology', region=region, product=product, days=days_added, seconds=round(time.perf_counter() - start_time, 3))
+            metrics.add(measurement, 'days_added', days_added)
+        print(f'{region} climatology complete')
+    metrics.finish_stage(measurement)
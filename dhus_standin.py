@@ -0,0 +1,171 @@
+import hashlib
+import json
+import os
+import re
+import sys
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import netCDF4
+import numpy as np
+
+# Local stand-in for the DHuS OpenSearch/OData API, serving the L2 NetCDF files of a directory.
+# Usage: python dhus_standin.py [directory] [port], then run query.py with DHUS_API_URL=http://localhost:[port]/dhus/
+
+# Define the directory containing the L2 files to serve and the port to listen on
+products_dir = sys.argv[1] if len(sys.argv) > 1 else 'Products_Standin/'
+port = int(sys.argv[2]) if len(sys.argv) > 2 else 8000
+
+
+# Return the footprint of an L2 file as WKT (bounding box of the pixel coordinates)
+def file_footprint(path):
+    try:
+        with netCDF4.Dataset(path) as dataset:
+            latitude = dataset['PRODUCT/latitude'][:]
+            longitude = dataset['PRODUCT/longitude'][:]
+        west, east, south, north = np.min(longitude), np.max(longitude), np.min(latitude), np.max(latitude)
+    except Exception:
+        west, east, south, north = -180, 180, -90, 90
+    return f'POLYGON(({west} {south},{east} {south},{east} {north},{west} {north},{west} {south}))'
+
+
+# Describe every L2 file of the directory as a product (uuid derived from the file name)
+def load_products():
+    products = {}
+    for filename in sorted(os.listdir(products_dir)):
+        if not filename.endswith('.nc'):
+            continue
+        path = os.path.join(products_dir, filename)
+        md5 = hashlib.md5()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(2 ** 20), b''):
+                md5.update(block)
+        identifier = filename[:-3]
+        products[str(uuid.uuid5(uuid.NAMESPACE_URL, identifier))] = {
+            'identifier': identifier,
+            'path': path,
+            'size': os.path.getsize(path),
+            'md5': md5.hexdigest().upper(),
+            'producttype': identifier[9:19],
+            'processingmode': 'Near real time' if identifier[4:8] == 'NRTI' else 'Offline',
+            'beginposition': datetime.strptime(identifier[20:35], '%Y%m%dT%H%M%S').replace(tzinfo=timezone.utc),
+            'endposition': datetime.strptime(identifier[36:51], '%Y%m%dT%H%M%S').replace(tzinfo=timezone.utc),
+            'orbitnumber': int(identifier[52:57]),
+            'footprint': file_footprint(path),
+        }
+    return products
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    products = {}
+
+    def send_json(self, content, status=200):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # OpenSearch search results (only the producttype keywords of the query are evaluated)
+    def search(self, parameters):
+        query = parameters.get('q', [''])[0]
+        product_types = set(re.findall(r'L2__\w{6}', query))
+        matches = [
+            (product_uuid, product) for product_uuid, product in self.products.items()
+            if not product_types or product['producttype'] in product_types
+        ]
+        start = int(parameters.get('start', ['0'])[0])
+        rows = int(parameters.get('rows', ['100'])[0])
+        entries = [{
+            'id': product_uuid,
+            'title': product['identifier'],
+            'link': [{'href': self.odata_url(product_uuid) + '/$value'}],
+            'summary': product['identifier'],
+            'str': [
+                {'name': 'identifier', 'content': product['identifier']},
+                {'name': 'producttype', 'content': product['producttype']},
+                {'name': 'processingmode', 'content': product['processingmode']},
+                {'name': 'platformname', 'content': 'Sentinel-5'},
+                {'name': 'footprint', 'content': product['footprint']},
+            ],
+            'date': [
+                {'name': 'beginposition', 'content': product['beginposition'].strftime('%Y-%m-%dT%H:%M:%SZ')},
+                {'name': 'endposition', 'content': product['endposition'].strftime('%Y-%m-%dT%H:%M:%SZ')},
+            ],
+            'int': [{'name': 'orbitnumber', 'content': str(product['orbitnumber'])}],
+        } for product_uuid, product in matches[start:start + rows]]
+        self.send_json({'feed': {'opensearch:totalResults': str(len(matches)), 'entry': entries}})
+
+    def odata_url(self, product_uuid):
+        return f'http://{self.headers["Host"]}/dhus/odata/v1/Products(\'{product_uuid}\')'
+
+    # OData product metadata
+    def metadata(self, product_uuid):
+        product = self.products[product_uuid]
+        timestamp = lambda date: f'/Date({int(date.timestamp() * 1000)})/'
+        self.send_json({'d': {
+            'Id': product_uuid,
+            'Name': product['identifier'],
+            'ContentLength': str(product['size']),
+            'Checksum': {'Algorithm': 'MD5', 'Value': product['md5']},
+            'ContentDate': {'Start': timestamp(product['beginposition']), 'End': timestamp(product['endposition'])},
+            'ContentGeometry': None,
+            'CreationDate': timestamp(product['endposition']),
+            'IngestionDate': timestamp(product['endposition']),
+            'Online': True,
+            '__metadata': {'media_src': self.odata_url(product_uuid) + '/$value'},
+            'Attributes': {'results': []},
+        }})
+
+    # OData product download, supporting single HTTP range requests to resume partial downloads
+    def content(self, product_uuid):
+        product = self.products[product_uuid]
+        start, end = 0, product['size'] - 1
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else end
+            if start > end:
+                self.send_response(416)
+                self.end_headers()
+                return
+        self.send_response(206 if match else 200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Content-Disposition', f'attachment; filename="{product["identifier"]}.nc"')
+        if match:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{product["size"]}')
+        self.end_headers()
+        with open(product['path'], 'rb') as file:
+            file.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                block = file.read(min(2 ** 20, remaining))
+                if not block:
+                    break
+                self.wfile.write(block)
+                remaining -= len(block)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        odata = re.fullmatch(r"/dhus/odata/v1/Products\('([\w-]+)'\)(/\$value)?", url.path)
+        if url.path == '/dhus/search':
+            self.search(parse_qs(url.query))
+        elif url.path == '/dhus/api/stub/version':
+            self.send_json({'value': '0.14.3-standin'})
+        elif odata and odata.group(1) in self.products:
+            if odata.group(2):
+                self.content(odata.group(1))
+            else:
+                self.metadata(odata.group(1))
+        else:
+            self.send_json({'error': {'message': {'value': f'Not found: {url.path}'}}}, status=404)
+
+
+if __name__ == '__main__':
+    StandinHandler.products = load_products()
+    print(f'Serving {len(StandinHandler.products)} products from {products_dir} at http://localhost:{port}/dhus/')
+    ThreadingHTTPServer(('', port), StandinHandler).serve_forever()
@@ -0,0 +1,120 @@
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Define the number of concurrent downloads (the DHuS hubs allow a limited number of concurrent downloads per user)
+num_download_workers = 4
+
+# Define the number of download attempts per product. Each attempt resumes the partially downloaded file
+download_attempts = 3
+
+# Define the suffix of partially downloaded files
+partial_suffix = '.incomplete'
+
+# Define the size of the blocks streamed to disk and read for checksum verification (bytes)
+block_size = 2 ** 20
+
+
+# Calculate the MD5 checksum of a file
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+# Download the remaining part of a file, starting at the size of the already downloaded part (HTTP range request)
+def download_remaining(session, url, partial_path, size):
+    offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+    if offset > size:
+        offset = 0
+    if offset == size:
+        return 0
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+    with session.get(url, headers=headers, stream=True, timeout=60) as response:
+        response.raise_for_status()
+        if offset and response.status_code != 206:     # Range not supported by the server, download the whole file
+            offset = 0
+        with open(partial_path, 'ab' if offset else 'wb') as file:
+            downloaded = 0
+            for block in response.iter_content(chunk_size=block_size):
+                file.write(block)
+                downloaded += len(block)
+    return downloaded
+
+
+# Download a single product. Partially downloaded files are resumed and the checksum of the complete file is
+# verified before it is renamed to its final name, so only complete and valid files end up in the directory
+def download_product(api, uuid, directory_path):
+    start_time = time.perf_counter()
+    downloaded = 0
+    error = None
+    title = uuid
+    path = None
+    try:
+        product_info = api.get_product_odata(uuid)
+        title = product_info['title']
+        path = os.path.join(directory_path, title + '.nc')
+        partial_path = path + partial_suffix
+        for attempt in range(download_attempts):
+            try:
+                downloaded += download_remaining(api.session, product_info['url'], partial_path, product_info['size'])
+            except Exception as exception:
+                error = str(exception)
+                continue
+            if 'md5' in product_info and file_md5(partial_path) != product_info['md5'].lower():
+                os.remove(partial_path)
+                error = 'checksum mismatch'
+                continue
+            os.replace(partial_path, path)
+            error = None
+            break
+    except Exception as exception:
+        error = str(exception)
+    return {'uuid': uuid, 'title': title, 'path': path, 'bytes': downloaded, 'seconds': time.perf_counter() - start_time, 'error': error}
+
+
+# Print a summary of the download results
+def print_summary(results, skipped):
+    downloaded = [result for result in results if result['error'] is None]
+    failed = [result for result in results if result['error'] is not None]
+    print(f'\nDownload summary: {len(downloaded)} downloaded, {len(failed)} failed, {len(skipped)} skipped (already downloaded or converted)')
+    if downloaded:
+        total_bytes = sum(result['bytes'] for result in downloaded)
+        total_seconds = sum(result['seconds'] for result in downloaded)
+        print(f'  Transferred {total_bytes / 1024 ** 2:.1f} MB in {total_seconds:.1f} s of download time')
+    if failed:
+        print('Failed downloads:')
+        for result in failed:
+            print(f'  {result["title"]}: {result["error"]}')
+
+
+# Download all products of a query that are not in the skip list, using a bounded pool of concurrent downloads.
+# The skip list contains the identifiers of products that are already downloaded or already converted to L3.
+# If given, on_download is called by the download worker with the result of every download as soon as it finished.
+# If given, the stop event cancels the downloads that have not started yet once it is set
+def download_all(api, products, directory_path, skip, on_download=None, stop=None):
+    skipped = [uuid for uuid, properties in products.items() if properties['identifier'] in skip]
+    results = []
+
+    def download(uuid):
+        if stop is not None and stop.is_set():
+            return {'uuid': uuid, 'title': uuid, 'path': None, 'bytes': 0, 'seconds': 0, 'error': 'cancelled'}
+        result = download_product(api, uuid, directory_path)
+        if on_download is not None:
+            on_download(result)
+        return result
+
+    with ThreadPoolExecutor(max_workers=num_download_workers) as executor:
+        futures = [
+            executor.submit(download, uuid)
+            for uuid, properties in products.items() if properties['identifier'] not in skip
+        ]
+        for future in as_completed(futures):
+            result = future.result()
+            print(f'{result["title"]}: {"downloaded" if result["error"] is None else "failed"}')
+            results.append(result)
+    print_summary(results, skipped)
+    return results
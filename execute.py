@@ -1,21 +1,138 @@
+import argparse
+import hashlib
 import os
+import subprocess
+import sys
+import time
+from datetime import datetime
+from glob import glob
 
 # Set working directory
 abspath = os.path.abspath(__file__)
 dir_name = os.path.dirname(abspath)
 os.chdir(dir_name)
 
-# Define list of scripts in the order to be executed in.
-scripts = ['query.py', 'process.py', 'multitemporal.py']
-
-# Execute each script in the list
-for script in scripts:
-    print(f'executing {script}')
-    try:
-        script_code = open(script, 'r', encoding='utf-8').read()
-        exec(script_code)
-        print(f'{script} successfully executed')
-    except FileNotFoundError:
-        print(f'{script} not found.')
-    except Exception as error:
-        print(f'Error executing {script}: {error}')
+# Define the stages of the workflow (Stage: script, inputs, outputs). Inputs and outputs are files or directories, a stage
+# depends on every earlier stage whose outputs it reads. Stages without inputs (None) depend on remote data and always run.
+# Each stage runs as its own process, so only the libraries of the stages that run are imported
+stages = {
+    'query': {'script': 'query.py', 'inputs': None, 'outputs': ['Products_Raw/']},
+    'convert': {'script': 'process.py', 'inputs': ['Products_Raw/'], 'outputs': ['Products_Processed/']},
+    'pipeline': {'script': 'pipeline.py', 'inputs': None, 'outputs': ['Products_Raw/', 'Products_Processed/', 'Products_Daily/']},
+    'aggregate': {'script': 'aggregate.py', 'inputs': ['Products_Processed/'], 'outputs': ['Products_Daily/']},
+    'climatology': {'script': 'climatology.py', 'inputs': ['Products_Daily/'], 'outputs': ['Products_Climatology/']},
+    'render': {'script': 'multitemporal.py', 'inputs': ['Products_Daily/', 'Products_Climatology/'], 'outputs': ['Output/']},     # output directories of the regions (regions.py)
+    'zonal': {'script': 'zonal.py', 'inputs': ['Products_Daily/'], 'outputs': ['Output_Zonal/']},
+    'export': {'script': 'multitemporal_tiff.py', 'inputs': ['Products_Daily/'], 'outputs': ['Output_GeoTIFF/', 'Output_Tiles/']},
+}
+
+# Define the stages run by default, in the order to be executed in.
+# With --pipelined, downloading, conversion and aggregation run as a streaming pipeline instead of consecutive stages
+default_stages = ['query', 'convert', 'aggregate', 'climatology', 'render', 'zonal']
+pipelined_stages = ['pipeline', 'climatology', 'render', 'zonal']
+
+# Define the files every stage depends on in addition to its inputs (code and region definitions)
+common_inputs = sorted(glob('*.py')) + ['Support_Files/']
+
+# Define the directory the fingerprints of the last successful run of every stage are stored in
+stamp_dir = 'Products_Stamps/'
+
+
+# Calculate a fingerprint of the inputs and outputs of a stage from the names, sizes and modification times of their files
+# (no file is read). The date is part of the fingerprint, as the time-frames of the stages move every day
+def fingerprint(stage):
+    digest = hashlib.sha1(datetime.now().strftime('%Y%m%d').encode())
+    for path in common_inputs + stages[stage]['inputs'] + stages[stage]['outputs']:
+        if os.path.isfile(path):
+            files = [path]
+        else:
+            files = sorted(os.path.join(root, filename) for root, _, filenames in os.walk(path) for filename in filenames)
+        for file in files:
+            try:
+                status = os.stat(file)
+            except FileNotFoundError:
+                continue    # deleted while scanning
+            digest.update(f'{file}:{status.st_size}:{status.st_mtime_ns};'.encode())
+    return digest.hexdigest()
+
+
+# Return the path of the fingerprint of the last successful run of a stage
+def stamp_path(stage):
+    return os.path.join(stamp_dir, f'{stage}.stamp')
+
+
+# Return why a stage has to run, or None if its inputs and outputs did not change since its last successful run
+def run_reason(stage, force):
+    if force:
+        return 'forced'
+    if stages[stage]['inputs'] is None:
+        return 'depends on remote data'
+    if not os.path.exists(stamp_path(stage)):
+        return 'no previous run'
+    with open(stamp_path(stage)) as file:
+        if file.read().strip() != fingerprint(stage):
+            return 'inputs changed'
+    return None
+
+
+# Run a stage as a separate process and record the fingerprint of its inputs and outputs if it succeeded
+def run_stage(stage):
+    start_time = time.perf_counter()
+    return_code = subprocess.run([sys.executable, stages[stage]['script']]).returncode
+    if return_code == 0 and stages[stage]['inputs'] is not None:
+        os.makedirs(stamp_dir, exist_ok=True)
+        with open(stamp_path(stage) + '.part', 'w') as file:
+            file.write(fingerprint(stage))
+        os.replace(stamp_path(stage) + '.part', stamp_path(stage))
+    return return_code, time.perf_counter() - start_time
+
+
+# Return the stages a stage depends on: the stages run before it whose outputs it reads
+def upstream_stages(stage, selected_stages):
+    inputs = stages[stage]['inputs'] or []
+    earlier_stages = selected_stages[:selected_stages.index(stage)]
+    return [earlier for earlier in earlier_stages if set(stages[earlier]['outputs']) & set(inputs)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the stages of the Sentinel-5P workflow, skipping stages whose inputs did not change.')
+    parser.add_argument('--stage', action='append', choices=list(stages), help='run only this stage (can be given several times)')
+    parser.add_argument('--pipelined', action='store_true', help='download, convert and aggregate as a streaming pipeline')
+    parser.add_argument('--dry-run', action='store_true', help='print the stages that would run without running them')
+    parser.add_argument('--force', action='store_true', help='run the stages even if their inputs did not change')
+    arguments = parser.parse_args()
+
+    if arguments.stage:
+        selected_stages = [stage for stage in stages if stage in arguments.stage]
+    else:
+        selected_stages = pipelined_stages if arguments.pipelined else default_stages
+
+    # Run every stage whose inputs changed, unless a stage it depends on failed (its inputs would be stale)
+    failed = []
+    executed = []
+    for stage in selected_stages:
+        script = stages[stage]['script']
+        failed_upstream = [upstream for upstream in upstream_stages(stage, selected_stages) if upstream in failed]
+        if failed_upstream:
+            print(f'{stage} ({script}): not executed, {", ".join(failed_upstream)} failed')
+            failed.append(stage)
+            continue
+        reason = run_reason(stage, arguments.force)
+        if reason is None and arguments.dry_run and set(upstream_stages(stage, selected_stages)) & set(executed):
+            reason = 'inputs will change'
+        if reason is None:
+            print(f'{stage} ({script}): up to date')
+            continue
+        executed.append(stage)
+        if arguments.dry_run:
+            print(f'{stage} ({script}): would be executed ({reason})')
+            continue
+        print(f'executing {stage} ({script}, {reason})')
+        return_code, seconds = run_stage(stage)
+        if return_code == 0:
+            print(f'{script} successfully executed in {seconds:.1f} s')
+        else:
+            print(f'Error executing {script}: exit code {return_code}')
+            failed.append(stage)
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,86 @@
+import math
+import os
+import shutil
+
+import matplotlib
+import numpy as np
+import rioxarray  # registers the .rio accessor of xarray objects
+from PIL import Image
+
+# Define the size of the internal tiles of the Cloud-Optimized GeoTIFFs and of the XYZ tiles (pixels)
+tile_size = 256
+
+# Define the compression of the Cloud-Optimized GeoTIFFs
+cog_compression = 'DEFLATE'
+
+# Define the colormap of the XYZ tiles (same as the PNG/JPG outputs)
+tile_colormap = 'magma_r'
+
+
+# Write a mean to a Cloud-Optimized GeoTIFF (EPSG:4326, float32, internally tiled, compressed, with overviews) with the given
+# metadata tags. The file is written under a temporary name and renamed once complete
+def write_cog(mean, path, tags):
+    raster = mean.astype('float32').sortby('latitude', ascending=False).sortby('longitude')
+    raster = raster.rio.set_spatial_dims(x_dim='longitude', y_dim='latitude').rio.write_crs('epsg:4326').rio.write_nodata(np.nan, encoded=False)
+    raster.rio.to_raster(path + '.part', driver='COG', compress=cog_compression, blocksize=tile_size, overview_resampling='average',
+                         tags={key: str(value) for key, value in tags.items()})
+    os.replace(path + '.part', path)
+
+
+# Return the range of XYZ (web mercator) tile columns and rows covering bounds (west, south, east, north) at a zoom level
+def tile_range(bounds, zoom):
+    west, south, east, north = bounds
+    tiles = 2 ** zoom
+
+    def tile_x(longitude):
+        return min(max(int((longitude + 180) / 360 * tiles), 0), tiles - 1)
+
+    def tile_y(latitude):
+        return min(max(int((1 - math.asinh(math.tan(math.radians(latitude))) / math.pi) / 2 * tiles), 0), tiles - 1)
+
+    return range(tile_x(west), tile_x(east) + 1), range(tile_y(north), tile_y(south) + 1)
+
+
+# Render one XYZ tile of a mean on a regular grid as an RGBA image (nearest cell, transparent outside the grid and for empty cells)
+def render_tile(values, latitude, longitude, x, y, zoom, colormap, norm):
+    tiles = 2 ** zoom
+    pixel = (np.arange(tile_size) + 0.5) / tile_size
+    pixel_longitude = (x + pixel) / tiles * 360 - 180
+    pixel_latitude = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + pixel) / tiles))))
+    column = np.rint((pixel_longitude - longitude[0]) / (longitude[1] - longitude[0])).astype(int)
+    row = np.rint((pixel_latitude - latitude[0]) / (latitude[1] - latitude[0])).astype(int)
+    inside_column = (column >= 0) & (column < longitude.size)
+    inside_row = (row >= 0) & (row < latitude.size)
+    tile = values[np.clip(row, 0, latitude.size - 1)[:, None], np.clip(column, 0, longitude.size - 1)[None, :]]
+    rgba = colormap(norm(tile), bytes=True)
+    rgba[~(inside_row[:, None] & inside_column[None, :]) | np.isnan(tile), 3] = 0
+    return Image.fromarray(rgba, 'RGBA')
+
+
+# Write an XYZ PNG tile pyramid ({zoom}/{x}/{y}.png) of a mean for the given zoom levels, coloured from vmin to vmax.
+# Tiles without any data are not written. The pyramid is written to a temporary directory and replaces the previous pyramid once complete
+def write_tiles(mean, directory, vmin, vmax, zoom_levels):
+    mean = mean.sortby(['latitude', 'longitude'])
+    values, latitude, longitude = mean.values, mean['latitude'].values, mean['longitude'].values
+    colormap = matplotlib.colormaps[tile_colormap]
+    norm = matplotlib.colors.Normalize(vmin=vmin, vmax=vmax)
+    bounds = longitude[0], latitude[0], longitude[-1], latitude[-1]
+
+    partial_directory = directory.rstrip('/') + '.part'
+    shutil.rmtree(partial_directory, ignore_errors=True)
+    tile_count = 0
+    for zoom in zoom_levels:
+        columns, rows = tile_range(bounds, zoom)
+        for x in columns:
+            for y in rows:
+                tile = render_tile(values, latitude, longitude, x, y, zoom, colormap, norm)
+                if tile.getextrema()[3][1] == 0:
+                    continue
+                os.makedirs(os.path.join(partial_directory, str(zoom), str(x)), exist_ok=True)
+                tile.save(os.path.join(partial_directory, str(zoom), str(x), f'{y}.png'), optimize=True)
+                tile_count += 1
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(os.path.dirname(directory.rstrip('/')), exist_ok=True)
+    if tile_count:
+        os.replace(partial_directory, directory)
+    return tile_count
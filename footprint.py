@@ -0,0 +1,69 @@
+import re
+
+import netCDF4
+import numpy as np
+
+# Define the number of scanlines kept on either side of the scanlines intersecting the area of interest
+# (pixel corners extend beyond the pixel centres used to select the scanlines)
+scanline_margin = 2
+
+
+# Return the rings of a WKT (MULTI)POLYGON as lists of (lon, lat) coordinates
+def wkt_rings(wkt):
+    return [
+        [tuple(float(value) for value in point.split()[:2]) for point in ring.split(',')]
+        for ring in re.findall(r'\(([^()]+)\)', wkt)
+    ]
+
+
+# Clip a ring to a rectangle (Sutherland-Hodgman algorithm)
+def clip_ring(ring, bounds):
+    west, south, east, north = bounds
+    edges = [
+        (lambda point: point[0] >= west, lambda a, b: (west, a[1] + (b[1] - a[1]) * (west - a[0]) / (b[0] - a[0]))),
+        (lambda point: point[0] <= east, lambda a, b: (east, a[1] + (b[1] - a[1]) * (east - a[0]) / (b[0] - a[0]))),
+        (lambda point: point[1] >= south, lambda a, b: (a[0] + (b[0] - a[0]) * (south - a[1]) / (b[1] - a[1]), south)),
+        (lambda point: point[1] <= north, lambda a, b: (a[0] + (b[0] - a[0]) * (north - a[1]) / (b[1] - a[1]), north)),
+    ]
+    for inside, intersection in edges:
+        points, ring = ring, []
+        for index, current in enumerate(points):
+            previous = points[index - 1]
+            if inside(current):
+                if not inside(previous):
+                    ring.append(intersection(previous, current))
+                ring.append(current)
+            elif inside(previous):
+                ring.append(intersection(previous, current))
+        if not ring:
+            break
+    return ring
+
+
+# Calculate the area of a ring (shoelace formula, in square degrees)
+def ring_area(ring):
+    return abs(sum(a[0] * b[1] - b[0] * a[1] for a, b in zip(ring, ring[1:] + ring[:1]))) / 2
+
+
+# Calculate the fraction of an area of interest (west, south, east, north) covered by a product footprint (WKT)
+def aoi_coverage(wkt, bounds):
+    west, south, east, north = bounds
+    covered_area = sum(ring_area(clip_ring(ring, bounds)) for ring in wkt_rings(wkt))
+    return min(covered_area / ((east - west) * (north - south)), 1)
+
+
+# Return the first and last scanline of an L2 file with pixels inside any of the areas of interest and the number of ground
+# pixels per scanline, read from the geolocation of the file only. Returns None if no pixel is inside the areas of interest
+def scanline_range(l2_path, areas_bounds):
+    with netCDF4.Dataset(l2_path) as dataset:
+        latitude = dataset['PRODUCT/latitude'][0]
+        longitude = dataset['PRODUCT/longitude'][0]
+    inside = np.zeros(latitude.shape, dtype=bool)
+    for west, south, east, north in areas_bounds:
+        inside |= np.ma.filled((latitude > south) & (latitude < north) & (longitude > west) & (longitude < east), False)
+    scanlines = np.flatnonzero(inside.any(axis=1))
+    if scanlines.size == 0:
+        return None
+    first_scanline = max(scanlines[0] - scanline_margin, 0)
+    last_scanline = min(scanlines[-1] + scanline_margin, latitude.shape[0] - 1)
+    return int(first_scanline), int(last_scanline), latitude.shape[1]
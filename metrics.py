@@ -0,0 +1,82 @@
+import json
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+try:
+    import resource     # Unix only, used to measure the peak memory of the stages
+except ImportError:
+    resource = None
+
+# Structured instrumentation of the stages. Every stage appends its events (e.g. one per downloaded or converted file) and its
+# totals to a JSON lines file, and writes its totals as Prometheus textfile (e.g. for the node_exporter textfile collector)
+
+# Define the directory the metrics are written to
+metrics_dir = 'Metrics/'
+
+# Define the JSON lines file the events of all stages are appended to
+events_path = metrics_dir + 'events.jsonl'
+
+# Define the prefix of the Prometheus metric names
+metric_prefix = 's5p'
+
+
+# Return the peak resident set size (bytes) of this process and of its terminated child processes (e.g. pool workers)
+def peak_rss():
+    if resource is None:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak if sys.platform == 'darwin' else peak * 1024     # bytes on macOS, kilobytes on Linux
+
+
+# Append an event to the JSON lines file. Each event is written with a single append, so several processes can record events
+def record(stage, event, **fields):
+    line = json.dumps({'time': datetime.now(timezone.utc).isoformat(timespec='seconds'), 'stage': stage, 'event': event, **fields})
+    os.makedirs(metrics_dir, exist_ok=True)
+    with open(events_path, 'a') as file:
+        file.write(line + '\n')
+
+
+# Start measuring a stage. The stage adds its totals (e.g. bytes downloaded) to the returned measurement
+def start_stage(stage):
+    return {'stage': stage, 'start_time': time.perf_counter(), 'totals': {}}
+
+
+# Add a value to a total of a stage
+def add(measurement, name, value=1):
+    measurement['totals'][name] = measurement['totals'].get(name, 0) + value
+
+
+# Call a function and return its result together with its wall time (seconds), e.g. to time the tasks of a process pool
+def timed_call(function, *args):
+    start_time = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start_time
+
+
+# Write the values of a stage as Prometheus textfile (one gauge per value, labelled with the stage). The file is written
+# under a temporary name and renamed once complete, so the collector never reads a partial file
+def write_textfile(stage, values):
+    lines = []
+    for name, value in values.items():
+        if value is None:
+            continue
+        metric = f'{metric_prefix}_stage_{name}'
+        lines += [f'# TYPE {metric} gauge', f'{metric}{{stage="{stage}"}} {value}']
+    path = os.path.join(metrics_dir, f'{stage}.prom')
+    os.makedirs(metrics_dir, exist_ok=True)
+    with open(path + '.part', 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+    os.replace(path + '.part', path)
+
+
+# Finish measuring a stage: record its wall time, peak memory, totals and any further values (e.g. rates) as JSON line and
+# as Prometheus textfile
+def finish_stage(measurement, **values):
+    seconds = time.perf_counter() - measurement['start_time']
+    values = {'duration_seconds': round(seconds, 3), 'peak_rss_bytes': peak_rss(), 'last_success_timestamp_seconds': int(time.time()),
+              **measurement['totals'], **values}
+    record(measurement['stage'], 'stage', **values)
+    write_textfile(measurement['stage'], values)
+    print(f'{measurement["stage"]} stage finished in {seconds:.1f} s')
@@ -0,0 +1,140 @@
+import os
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import aggregate
+import catalog
+import download
+import metrics
+import process
+import query
+import regions
+
+# Define the maximum number of downloaded products waiting for a free conversion worker. Download workers pause while the queue is full
+conversion_queue_size = 2 * process.num_workers
+
+
+# Add the L3 files of a product to its daily aggregates of every region
+def aggregate_product(product):
+    for region in regions.regions:
+        aggregate.update_region(region, 'pipeline', [product])
+    print(f'{product} aggregation complete')
+
+
+if __name__ == '__main__':
+    measurement = metrics.start_stage('pipeline')
+    process.delete_partial_files()
+    catalog.sync()
+
+    # Query the products and define the products to download
+    products = query.query_products()
+    catalog.register_query(products)
+    skip = catalog.skip_list()
+    new_products = {uuid: properties for uuid, properties in products.items() if properties['identifier'] not in skip}
+    skipped = [properties['identifier'] for properties in products.values() if not process.missing_regions(properties['identifier'] + '.nc')]
+
+    # Define raw files that were downloaded but not converted (e.g. by an interrupted run)
+    unconverted_files = [file for file in catalog.raw_files(products=aggregate.product_attributes) if process.missing_regions(file)]
+
+    # Count the downloads and conversions that are still to be completed for every product
+    pending = {product: 0 for product in aggregate.product_attributes}
+    for properties in new_products.values():
+        pending[process.file_product(properties['identifier'])] += 1
+    for file in unconverted_files:
+        pending[process.file_product(file)] += 1
+
+    # Hand every product over to the conversion stage as soon as its download is complete
+    handoff = queue.Queue(maxsize=conversion_queue_size)
+
+    download_results = []
+    download_errors = []
+    stop_downloads = threading.Event()
+
+    # Hand a download result over to the conversion stage, giving up once the downloads are stopped so a download worker never
+    # blocks on a full queue that is no longer read
+    def hand_over(result):
+        while not stop_downloads.is_set():
+            try:
+                handoff.put(result, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+    # Download the products, always signalling the end of the downloads (None) so the stage does not wait forever if downloading
+    # fails (e.g. authentication error, disk full). The error is raised in the main thread once the running conversions are complete
+    def run_downloads():
+        try:
+            download_results.extend(download.download_all(query.api, new_products, query.raw_dir, skip, on_download=hand_over, stop=stop_downloads))
+        except BaseException as error:
+            download_errors.append(error)
+        finally:
+            hand_over(None)
+
+    results = []
+    conversions = {}
+    aggregated = set()
+    with ProcessPoolExecutor(max_workers=process.num_workers, initializer=process.limit_worker_memory, initargs=(process.worker_memory_limit,)) as executor, \
+            ThreadPoolExecutor(max_workers=1) as aggregator:
+        # Start all conversion workers before the download threads are started, so no worker is forked while downloads are running
+        wait([executor.submit(os.getpid) for _ in range(process.num_workers)])
+
+        def submit_conversion(file):
+            product = process.file_product(file)
+            conversions[executor.submit(process.convert_product, file, product, process.missing_regions(file))] = product
+
+        for file in unconverted_files:
+            submit_conversion(file)
+        downloader = threading.Thread(target=run_downloads)
+        downloader.start()
+
+        # Stop the downloads if the conversion or aggregation fails (e.g. a crashed conversion worker), so the download thread
+        # ends and the error is raised instead of the stage waiting for a queue that is no longer read
+        try:
+            downloads_finished = False
+            aggregations = []
+            while not downloads_finished or conversions or (not download_errors and len(aggregated) < len(pending)):
+                # Only take a download from the queue while a conversion worker is free, so the queue fills up and the download
+                # workers pause while the conversions are behind
+                if len(conversions) < process.num_workers:
+                    try:
+                        result = handoff.get(timeout=0.5)
+                        if result is None:
+                            downloads_finished = True
+                        elif result['error'] is None:
+                            catalog.set_raw_path(catalog.file_identifier(result['path']), result['path'])
+                            submit_conversion(result['path'])
+                        else:
+                            pending[process.file_product(new_products[result['uuid']]['identifier'])] -= 1
+                    except queue.Empty:
+                        pass
+                else:
+                    wait(conversions, timeout=0.5, return_when=FIRST_COMPLETED)
+
+                for future in [future for future in conversions if future.done()]:
+                    pending[conversions.pop(future)] -= 1
+                    results.append(future.result())
+                    process.record_conversion(results[-1])
+
+                # Aggregate every product as soon as all of its downloads and conversions are complete
+                for product, count in pending.items():
+                    if count == 0 and product not in aggregated:
+                        aggregated.add(product)
+                        aggregations.append(aggregator.submit(aggregate_product, product))
+        finally:
+            stop_downloads.set()
+            downloader.join()
+        for future in aggregations:
+            future.result()
+    if download_errors:
+        raise download_errors[0]
+
+    process.print_summary(results, skipped)
+    metrics.add(measurement, 'products_queried', len(products))
+    query.record_download_metrics(measurement, download_results)
+    process.record_conversion_metrics(measurement, results, skipped)
+
+    print('Checking for outdated product files...')
+    query.delete_outdated_products()
+    process.delete_outdated_products()
+    metrics.finish_stage(measurement)
@@ -1,86 +1,346 @@
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime, timedelta
 
 import harp
+import netCDF4
+import numpy as np
+
+import aggregate
+import catalog
+import footprint
+import metrics
+import regions
+
+try:
+    import resource     # Unix only, used to cap the memory of each conversion worker
+except ImportError:
+    resource = None
 
 # Define directory containing the raw files
 raw_dir = 'Products_Raw/'
 
-# Define and create (if necessary) directory to save the processed (L3) files to
+# Define directory to save the processed (L3) files to (one sub-directory per region, created when the first L3 file is written)
 processed_dir = 'Products_Processed/'
-os.makedirs(processed_dir, exist_ok=True)
 
 # Define time variables for filtering
 current_date = datetime.now()
 one_week_ago = current_date - timedelta(days=7)
 two_weeks_ago = current_date - timedelta(days=14)
 
-# Define the L2 (raw) product NetCDF files
-l2_product_files = {
-    'HCHO': [raw_dir + filename for filename in os.listdir(raw_dir) if 'L2__HCHO' in filename],
-    'NO2': [raw_dir + filename for filename in os.listdir(raw_dir) if 'L2__NO2' in filename],
-    'SO2': [raw_dir + filename for filename in os.listdir(raw_dir) if 'L2__SO2' in filename],
-    'CH4': [raw_dir + filename for filename in os.listdir(raw_dir) if 'L2__CH4' in filename],
-    'CO': [raw_dir + filename for filename in os.listdir(raw_dir) if 'L2__CO' in filename]
-}
+# Define the number of parallel conversion workers and the address space ceiling of each worker (bytes, None for no limit).
+# The ceiling limits virtual memory (RLIMIT_AS), not resident memory: HARP, netCDF4/HDF5 and numpy reserve far more address
+# space than they use, so a limit has to be set well above the expected peak memory of a conversion (e.g. 16 GB)
+num_workers = os.cpu_count() or 1
+worker_memory_limit = None
+
+# Define whether raw (L2) files are deleted right after their successful conversion to L3 to save disk space
+purge_raw_files = False
+
+# Define the reference time of the L3 time coordinate (same epoch as used by HARP)
+time_units = 'seconds since 2010-01-01 00:00:00'
+time_reference = datetime(2010, 1, 1)
+
+# Define the suffix of partially written L3 files. Files are renamed to their final name once completely written
+partial_suffix = '.part'
+
+# Define the L3 storage format. Compact L3 files only store the window of the grid of the region containing valid cells (with its
+# offset into the grid), packed as float32 or as int16 scaled to the value range of the file, and zlib-compressed.
+# If set to False, the files are exported by HARP instead (float64, uncompressed, full grid with cell bounds)
+compact_l3_files = True
+l3_packing = 'float32'      # 'float32' or 'int16'
+l3_compression_level = 4
 
-# Define HARP processing steps
-harp_op_template = '''
+# Define HARP processing steps applied once when importing an L2 product (filtered to the extent enclosing all regions)
+harp_import_template = '''
                 {validity}>75;
                 derive(datetime_stop {{time}});
-                latitude > 5 [degree_north] ; latitude < 21 [degree_north] ; longitude > 95 [degree_east] ; longitude < 110 [degree_east];
-                bin_spatial(1600, 5, 0.01, 1500, 95, 0.01);
+                latitude > {south} [degree_north] ; latitude < {north} [degree_north] ; longitude > {west} [degree_east] ; longitude < {east} [degree_east]
+            '''
+
+# Define HARP processing steps applied to the imported product for every region
+harp_region_template = '''
+                latitude > {south} [degree_north] ; latitude < {north} [degree_north] ; longitude > {west} [degree_east] ; longitude < {east} [degree_east];
+                bin_spatial({grid});
                 derive(latitude {{latitude}}); derive(longitude {{longitude}});
                 keep({attribute}, latitude, longitude, latitude_bounds, longitude_bounds)
             '''
 
-# Define attributes for each pollutant (Product: [HARP field name, quality descriptor])
-product_attributes = {
-    'HCHO': ['tropospheric_HCHO_column_number_density', 'tropospheric_HCHO_column_number_density_validity'],
-    'NO2': ['tropospheric_NO2_column_number_density', 'tropospheric_NO2_column_number_density_validity'],
-    'SO2': ['SO2_column_number_density', 'SO2_column_number_density_validity'],
-    'CH4': ['CH4_column_volume_mixing_ratio_dry_air', 'CH4_column_volume_mixing_ratio_dry_air_validity'],
-    'CO': ['CO_column_number_density', 'CO_column_number_density_validity']
+# Define the conversion settings of each pollutant (Product: [quality descriptor, L3 grid cell size in degrees], HARP field names in
+# aggregate.py). The cell size follows the TROPOMI pixel size of the product, finer grids only oversample the pixels and increase the binning time
+product_conversion = {
+    'HCHO': ['tropospheric_HCHO_column_number_density_validity', 0.025],     # 5.5 x 3.5 km pixels
+    'NO2': ['tropospheric_NO2_column_number_density_validity', 0.025],       # 5.5 x 3.5 km pixels
+    'SO2': ['SO2_column_number_density_validity', 0.025],                    # 5.5 x 3.5 km pixels
+    'CH4': ['CH4_column_volume_mixing_ratio_dry_air_validity', 0.05],        # 7 x 5.5 km pixels
+    'CO': ['CO_column_number_density_validity', 0.05]                        # 7 x 5.5 km pixels
 }
 
-# Process every product file using the HARP processing steps
-for product, files in l2_product_files.items():
-    print(f'Processing {product} files...')
-    attribute = product_attributes[product][0]
-    validity = product_attributes[product][1]
-    harp_op = harp_op_template.format(product, attribute=attribute, validity=validity)
-    for file in files:
-        l3_product_name = os.path.basename(file).replace('L2', 'L3')
-        l3_product_path = os.path.join(processed_dir, l3_product_name)
-        if os.path.exists(l3_product_path):
-            print(f'L3 product already exists for {file}. Skipping processing.')
+
+# Raised when a product has no valid cells inside the area of interest or a region. Such regions are recorded as converted
+# without L3 file, so the product is not imported again for them
+class NoValidCellsError(ValueError):
+    pass
+
+
+# Limit the address space of a conversion worker so a single large product cannot exhaust the memory of the machine
+def limit_worker_memory(memory_limit):
+    if resource is not None and memory_limit is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+
+# Read the time coverage attributes of an L2 file
+def read_time_coverage(l2_path):
+    with netCDF4.Dataset(l2_path) as l2_dataset:
+        return l2_dataset.getncattr('time_coverage_start'), l2_dataset.getncattr('time_coverage_end')
+
+
+# Copy the time coverage attributes of the L2 file into the L3 file and add a time coordinate,
+# so the L3 file can be aggregated without reopening the L2 file
+def add_time_coverage(l3_product_path, time_coverage_start, time_coverage_end):
+    with netCDF4.Dataset(l3_product_path, 'a') as l3_dataset:
+        l3_dataset.setncattr('time_coverage_start', time_coverage_start)
+        l3_dataset.setncattr('time_coverage_end', time_coverage_end)
+        if 'time' not in l3_dataset.dimensions:
+            l3_dataset.createDimension('time', 1)
+        if 'time' not in l3_dataset.variables:
+            start_time = datetime.strptime(time_coverage_start[:19], '%Y-%m-%dT%H:%M:%S')
+            time_variable = l3_dataset.createVariable('time', 'f8', ('time',))
+            time_variable.units = time_units
+            time_variable.standard_name = 'time'
+            time_variable[:] = [(start_time - time_reference).total_seconds()]
+
+
+# Write the binned attribute of a HARP product to a compact L3 file: the window of the grid containing valid cells, its offset into
+# the grid and the full grid coordinates, packed and compressed as defined by l3_packing and l3_compression_level
+def export_compact(harp_product, attribute, path):
+    grid = harp_product[attribute].data[0]
+    latitude = harp_product['latitude'].data
+    longitude = harp_product['longitude'].data
+    valid = ~np.isnan(grid)
+    rows = np.flatnonzero(valid.any(axis=1))
+    columns = np.flatnonzero(valid.any(axis=0))
+    if rows.size == 0:
+        raise NoValidCellsError('product contains no valid cells inside the region')
+    first_row, last_row, first_column, last_column = rows[0], rows[-1] + 1, columns[0], columns[-1] + 1
+    window = grid[first_row:last_row, first_column:last_column]
+
+    with netCDF4.Dataset(path, 'w') as dataset:
+        dataset.createDimension('time', 1)
+        dataset.createDimension('latitude', window.shape[0])
+        dataset.createDimension('longitude', window.shape[1])
+        dataset.createDimension('grid_latitude', latitude.size)
+        dataset.createDimension('grid_longitude', longitude.size)
+        dataset.row_offset = int(first_row)
+        dataset.column_offset = int(first_column)
+        for name, values, units in [
+            ('latitude', latitude[first_row:last_row], 'degree_north'), ('longitude', longitude[first_column:last_column], 'degree_east'),
+            ('grid_latitude', latitude, 'degree_north'), ('grid_longitude', longitude, 'degree_east')
+        ]:
+            variable = dataset.createVariable(name, 'f8', (name,))
+            variable.units = units
+            variable[:] = values
+        if l3_packing == 'int16':
+            variable = dataset.createVariable(attribute, 'i2', ('time', 'latitude', 'longitude'), zlib=True, complevel=l3_compression_level,
+                                              chunksizes=(1,) + window.shape, fill_value=np.int16(-32768))
+            minimum, maximum = np.nanmin(window), np.nanmax(window)
+            variable.add_offset = (minimum + maximum) / 2
+            variable.scale_factor = (maximum - minimum) / 65532 if maximum > minimum else 1.0
         else:
-            try:
-                harp_L2_L3 = harp.import_product(file, operations=harp_op)
-                harp.export_product(harp_L2_L3, l3_product_path, file_format='netcdf')
-                print(f'{file} successfully converted to L3.')
-            except Exception as error:
-                print(f'Error: {error}. Skipping processing for {file}.') # "Error: product contains no variables, or variables without data." when no cells of a product are greater than the minimum validity threshold
-    print(f'{product} processing complete')
-
-# Define L3 products that have nrt and offl availability
-offl_nrt_products = [processed_dir + filename for filename in os.listdir(processed_dir) if not filename.startswith('S5P_OFFL_L3__CH4____')]
-
-# Define L3 products that only have offl availability
-offl_only_products = [processed_dir + filename for filename in os.listdir(processed_dir) if filename.startswith('S5P_OFFL_L3__CH4____')]
-
-# Delete L3 products with nrt availability that are over 1 week old
-for file in offl_nrt_products:
-    filename = os.path.basename(file)
-    file_date = datetime.strptime(filename[20:28], '%Y%m%d')
-    if file_date < one_week_ago:
-        os.remove(file)
-        print(f'Deleted: {file}')
+            variable = dataset.createVariable(attribute, 'f4', ('time', 'latitude', 'longitude'), zlib=True, complevel=l3_compression_level,
+                                              chunksizes=(1,) + window.shape, fill_value=np.float32(np.nan))
+        if harp_product[attribute].unit is not None:
+            variable.units = harp_product[attribute].unit
+        variable[0] = np.ma.masked_invalid(window)
+
+
+# Convert a single L2 file to L3 for the given regions. The L2 file is imported once and binned onto the grid of every region.
+# Each L3 file is written under a temporary name and renamed once complete, so an interrupted run never leaves a half-written
+# L3 file behind that would be skipped as already processed.
+# Only the scanlines intersecting the regions are imported, files without any pixel inside them are not imported at all.
+# Regions without valid cells are returned as empty regions rather than errors, only failed regions are converted again
+def convert_product(file, product, regions_to_convert):
+    start_time = time.perf_counter()
+    bytes_read = os.path.getsize(file)
+    errors = {}
+    empty_regions = []
+    try:
+        scanlines = footprint.scanline_range(file, [regions.region_bounds(region) for region in regions_to_convert])
+        if scanlines is None:
+            raise NoValidCellsError('product contains no pixels inside the area of interest')
+        first_scanline, last_scanline, ground_pixels = scanlines
+        harp_op = f'index(time) >= {first_scanline * ground_pixels}; index(time) < {(last_scanline + 1) * ground_pixels};' + harp_import_operations(product)
+        harp_L2 = harp.import_product(file, operations=harp_op)
+        time_coverage = read_time_coverage(file)
+    except (NoValidCellsError, harp.NoDataError):
+        empty_regions = list(regions_to_convert)
+        harp_L2 = None
+    except Exception as exception:
+        return {'file': file, 'seconds': time.perf_counter() - start_time, 'error': str(exception), 'l3_paths': {}, 'empty_regions': [],
+                'purged': False, 'bytes_read': bytes_read, 'bytes_written': 0, 'peak_rss_bytes': metrics.peak_rss()}
 
-# Delete L3 offl only products that are over 2 weeks old
-for file in offl_only_products:
-    filename = os.path.basename(file)
-    file_date = datetime.strptime(filename[20:28], '%Y%m%d')
-    if file_date < two_weeks_ago:
+    l3_paths = {}
+    for region in [] if harp_L2 is None else regions_to_convert:
+        l3_product_path = l3_path(file, region)
+        partial_path = l3_product_path + partial_suffix
+        os.makedirs(os.path.dirname(l3_product_path), exist_ok=True)
+        try:
+            harp_L2_L3 = harp.execute_operations(harp_L2, harp_region_operations(product, region))
+            if compact_l3_files:
+                export_compact(harp_L2_L3, aggregate.product_attributes[product][0], partial_path)
+            else:
+                harp.export_product(harp_L2_L3, partial_path, file_format='netcdf')
+            add_time_coverage(partial_path, *time_coverage)
+            os.replace(partial_path, l3_product_path)
+            l3_paths[region] = l3_product_path
+        except (NoValidCellsError, harp.NoDataError):
+            empty_regions.append(region)     # no cells of the product inside the region are greater than the minimum validity threshold
+        except Exception as exception:
+            errors[region] = str(exception)
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+    if purge_raw_files and not errors:
         os.remove(file)
-        print(f'Deleted: {file}')
+    error = '; '.join(f'{region}: {error}' for region, error in errors.items()) if errors else None
+    return {'file': file, 'seconds': time.perf_counter() - start_time, 'error': error, 'l3_paths': l3_paths, 'empty_regions': empty_regions,
+            'purged': purge_raw_files and not errors,
+            'bytes_read': bytes_read, 'bytes_written': sum(os.path.getsize(path) for path in l3_paths.values()), 'peak_rss_bytes': metrics.peak_rss()}
+
+
+# Record the L3 files written by a conversion, the regions without valid cells (and the purged L2 file) in the catalog
+def record_conversion(result):
+    identifier = catalog.file_identifier(result['file'])
+    for region, path in result['l3_paths'].items():
+        catalog.set_l3_path(identifier, region, path)
+    for region in result['empty_regions']:
+        catalog.set_l3_empty(identifier, region)
+    if result['purged']:
+        catalog.set_raw_path(identifier, None)
+
+
+# Return the product (e.g. 'NO2') of an L2 file from its file name, None for files of other products
+def file_product(file):
+    for product in aggregate.product_attributes:
+        if f'L2__{product}' in os.path.basename(file):
+            return product
+    return None
+
+
+# Return the HARP processing steps applied when importing an L2 file of a product
+def harp_import_operations(product):
+    attribute = aggregate.product_attributes[product][0]
+    validity = product_conversion[product][0]
+    west, south, east, north = regions.union_bounds()
+    return harp_import_template.format(product, attribute=attribute, validity=validity, west=west, south=south, east=east, north=north)
+
+
+# Return the HARP processing steps binning an imported product onto the grid of a region
+def harp_region_operations(product, region):
+    attribute = aggregate.product_attributes[product][0]
+    west, south, east, north = regions.region_bounds(region)
+    grid = ', '.join(str(value) for value in regions.region_grid(region, product_conversion[product][1]))
+    return harp_region_template.format(attribute=attribute, grid=grid, west=west, south=south, east=east, north=north)
+
+
+# Return the path of the L3 file of an L2 file for a region
+def l3_path(file, region):
+    l3_product_name = os.path.basename(file).replace('L2', 'L3')
+    return os.path.join(processed_dir, region, l3_product_name)
+
+
+# Return the regions an L2 file has not been converted to L3 for yet
+def missing_regions(file):
+    return catalog.missing_regions(catalog.file_identifier(file))
+
+
+# Remove partially written L3 files left behind by an interrupted run
+def delete_partial_files():
+    for region in regions.regions:
+        region_dir = processed_dir + region + '/'
+        if not os.path.isdir(region_dir):
+            continue
+        for filename in os.listdir(region_dir):
+            if filename.endswith(partial_suffix):
+                os.remove(region_dir + filename)
+                print(f'Deleted incomplete L3 file: {region_dir + filename}')
+
+
+# Delete L3 products that are older than the query time-frames
+def delete_outdated_products():
+    for region in regions.regions:
+        # Define L3 products with nrt availability that are over 1 week old and offl only products that are over 2 weeks old
+        outdated_files = catalog.l3_files(region, excluded_products=catalog.offl_only_products, sensed_before=one_week_ago) + \
+            catalog.l3_files(region, products=catalog.offl_only_products, sensed_before=two_weeks_ago)
+
+        # Delete the outdated products
+        for file in outdated_files:
+            if os.path.exists(file):
+                os.remove(file)
+                print(f'Deleted: {file}')
+            catalog.set_l3_path(catalog.file_identifier(file), region, None)
+        catalog.set_expired([catalog.file_identifier(file) for file in outdated_files])
+
+
+# Record the metrics of the conversions: one event per converted file (including the peak memory of its worker) and the totals of the stage
+def record_conversion_metrics(measurement, results, skipped):
+    for result in results:
+        metrics.record(measurement['stage'], 'convert', product=os.path.basename(result['file']), seconds=round(result['seconds'], 3),
+                       bytes_read=result['bytes_read'], bytes_written=result['bytes_written'], regions=len(result['l3_paths']), empty_regions=len(result['empty_regions']),
+                       worker_peak_rss_bytes=result['peak_rss_bytes'], error=result['error'])
+        metrics.add(measurement, 'files_failed' if result['error'] else 'files_converted')
+        metrics.add(measurement, 'l2_bytes_read', result['bytes_read'])
+        metrics.add(measurement, 'l3_bytes_written', result['bytes_written'])
+        metrics.add(measurement, 'conversion_seconds', round(result['seconds'], 3))
+    metrics.add(measurement, 'files_skipped', len(skipped))
+
+
+# Print a summary of the conversion results
+def print_summary(results, skipped):
+    converted = [result for result in results if result['error'] is None]
+    failed = [result for result in results if result['error'] is not None]
+    print(f'\nConversion summary: {len(converted)} converted, {len(failed)} failed, {len(skipped)} skipped (L3 product already exists or superseded by an OFFL/newer product of the orbit)')
+    for result in sorted(converted, key=lambda result: result['seconds'], reverse=True):
+        print(f'  {result["seconds"]:8.1f} s  {os.path.basename(result["file"])}')
+    if converted:
+        total_seconds = sum(result['seconds'] for result in converted)
+        print(f'  Total conversion time: {total_seconds:.1f} s ({total_seconds / len(converted):.1f} s per file)')
+    if failed:
+        print('Failed conversions:')
+        for result in failed:
+            print(f'  {os.path.basename(result["file"])}: {result["error"]}')
+
+
+if __name__ == '__main__':
+    measurement = metrics.start_stage('convert')
+    delete_partial_files()
+    catalog.sync()
+
+    # Define the L2 (raw) product NetCDF files
+    l2_product_files = {product: catalog.raw_files(products=[product]) for product in aggregate.product_attributes}
+
+    # Process every product file using the HARP processing steps, distributing the files over the worker pool
+    results = []
+    skipped = []
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=limit_worker_memory, initargs=(worker_memory_limit,)) as executor:
+        futures = []
+        for product, files in l2_product_files.items():
+            for file in files:
+                regions_to_convert = missing_regions(file)
+                if not regions_to_convert:
+                    skipped.append(file)
+                else:
+                    futures.append(executor.submit(convert_product, file, product, regions_to_convert))
+        print(f'Converting {len(futures)} L2 files to L3 using {num_workers} workers...')
+        for future in as_completed(futures):
+            results.append(future.result())
+            record_conversion(results[-1])
+    print_summary(results, skipped)
+    record_conversion_metrics(measurement, results, skipped)
+
+    delete_outdated_products()
+
+    # Record the conversion rate of the stage (converted files and L2 bytes per second of wall time)
+    seconds = time.perf_counter() - measurement['start_time']
+    metrics.finish_stage(measurement, conversion_rate_files_per_second=round(measurement['totals'].get('files_converted', 0) / seconds, 4),
+                         conversion_rate_bytes_per_second=round(measurement['totals'].get('l2_bytes_read', 0) / seconds))
@@ -1,63 +1,105 @@
 import os
 from datetime import datetime, timedelta
 
-from sentinelsat import SentinelAPI, read_geojson, geojson_to_wkt
+from sentinelsat import SentinelAPI
 
-# Define copernicus open access hub connection
-api = SentinelAPI('s5pguest', 's5pguest', 'https://s5phub.copernicus.eu/dhus/')
+import catalog
+import download
+import footprint
+import metrics
+import regions
 
-# Define aoi as wkt
-area = geojson_to_wkt(read_geojson('Support_Files/thailand_boundary_simple.geojson'))     # geojson downloaded from: https://cartographyvectors.com/map/1048-thailand-detailed-boundary
+# Define copernicus open access hub connection (the hub URL can be overridden, e.g. to point to a local stand-in server)
+api_url = os.environ.get('DHUS_API_URL', 'https://s5phub.copernicus.eu/dhus/')
+api = SentinelAPI('s5pguest', 's5pguest', api_url, show_progressbars=False)
 
 # Define time variables for filtering
 current_date = datetime.now()
 one_week_ago = current_date - timedelta(days=7)
 two_weeks_ago = current_date - timedelta(days=14)
 
-# Query nrt available products from api, searching by aoi, time, and query keywords
-query_nrt_offl_products = api.query(
-    area,
-    date=(one_week_ago, current_date),
-    platformname='Sentinel-5',
-    producttype={'L2__NO2___', 'L2__HCHO__', 'L2__SO2___', 'L2__CO____'}
-)
-
-# Query offl only products from api, searching by aoi, time, and query keywords
-query_offl_only_products = api.query(
-    area,
-    date=(two_weeks_ago, one_week_ago),     # CH4 updated “within about 5 days after sensing”
-    platformname='Sentinel-5',
-    producttype='L2__CH4___'
-)
-
 # Define and create (if necessary) directory to download the raw files to
 raw_dir = 'Products_Raw/'
 os.makedirs(raw_dir, exist_ok=True)
 
-# Download all products from the queries
-api.download_all(query_nrt_offl_products, directory_path=raw_dir)
-api.download_all(query_offl_only_products, directory_path=raw_dir)
-
-print('Successfully downloaded all product files\nChecking for outdated product files...')
-
-# Define products that only have nrt and offl availability
-offl_nrt_products = [raw_dir + filename for filename in os.listdir(raw_dir) if not filename.startswith('S5P_OFFL_L2__CH4____')]
-
-# Define products that only have offl availability
-offl_only_products = [raw_dir + filename for filename in os.listdir(raw_dir) if filename.startswith('S5P_OFFL_L2__CH4____')]
-
-# Delete products with nrt availibility that are over 1 week old
-for file in offl_nrt_products:
-    filename = os.path.basename(file)
-    file_date = datetime.strptime(filename[20:28], '%Y%m%d')
-    if file_date < one_week_ago:
-        os.remove(file)
-        print(f'Deleted: {file}')
-
-# Delete offl only products that are over 2 weeks old
-for file in offl_only_products:
-    filename = os.path.basename(file)
-    file_date = datetime.strptime(filename[20:28], '%Y%m%d')
-    if file_date < two_weeks_ago:
-        os.remove(file)
-        print(f'Deleted: {file}')
+# Define the minimum fraction of the area of interest a product footprint has to cover for the product to be downloaded
+min_aoi_coverage = 0.05
+
+
+# Query the products to download from the api, searching by aoi, time, and query keywords.
+# Every region is queried, products covering several regions are only returned (and downloaded) once
+def query_products():
+    products = {}
+    for region in regions.regions:
+        # Define aoi as wkt
+        area = regions.region_area(region)
+
+        # Query nrt available products
+        query_nrt_offl_products = api.query(
+            area,
+            date=(one_week_ago, current_date),
+            platformname='Sentinel-5',
+            producttype={'L2__NO2___', 'L2__HCHO__', 'L2__SO2___', 'L2__CO____'}
+        )
+
+        # Query offl only products
+        query_offl_only_products = api.query(
+            area,
+            date=(two_weeks_ago, one_week_ago),     # CH4 updated “within about 5 days after sensing”
+            platformname='Sentinel-5',
+            producttype='L2__CH4___'
+        )
+        products.update(query_nrt_offl_products)
+        products.update(query_offl_only_products)
+
+    # Skip products that only cover a sliver of the area of interest of every region
+    covering_products = {
+        uuid: properties for uuid, properties in products.items()
+        if 'footprint' not in properties or max(footprint.aoi_coverage(properties['footprint'], regions.region_bounds(region)) for region in regions.regions) >= min_aoi_coverage
+    }
+    print(f'{len(products) - len(covering_products)} of {len(products)} products cover less than {min_aoi_coverage:.0%} of the area of interest and are skipped')
+    return covering_products
+
+
+# Record the metrics of the downloads: one event per download and the totals of the stage
+def record_download_metrics(measurement, results):
+    for result in results:
+        metrics.record(measurement['stage'], 'download', product=result['title'], bytes=result['bytes'], seconds=round(result['seconds'], 3), error=result['error'])
+        metrics.add(measurement, 'downloads_failed' if result['error'] else 'products_downloaded')
+        metrics.add(measurement, 'bytes_downloaded', result['bytes'])
+        metrics.add(measurement, 'download_seconds', round(result['seconds'], 3))
+
+
+# Delete raw products that are older than the query time-frames
+def delete_outdated_products():
+    # Define products with nrt availability that are over 1 week old and offl only products that are over 2 weeks old
+    outdated_files = catalog.raw_files(excluded_products=catalog.offl_only_products, sensed_before=one_week_ago) + \
+        catalog.raw_files(products=catalog.offl_only_products, sensed_before=two_weeks_ago)
+
+    # Delete the outdated products
+    for file in outdated_files:
+        if os.path.exists(file):
+            os.remove(file)
+            print(f'Deleted: {file}')
+        catalog.set_raw_path(catalog.file_identifier(file), None)
+    catalog.set_expired([catalog.file_identifier(file) for file in outdated_files])
+
+
+if __name__ == '__main__':
+    measurement = metrics.start_stage('query')
+    catalog.sync()
+
+    # Download all new products from the queries, skipping products that are already downloaded or already converted to L3 for
+    # every region (their raw files may have been purged after conversion)
+    products = query_products()
+    catalog.register_query(products)
+    results = download.download_all(api, products, raw_dir, catalog.skip_list())
+    metrics.add(measurement, 'products_queried', len(products))
+    record_download_metrics(measurement, results)
+    for result in results:
+        if result['error'] is None:
+            catalog.set_raw_path(catalog.file_identifier(result['path']), result['path'])
+
+    print('Checking for outdated product files...')
+    delete_outdated_products()
+    metrics.finish_stage(measurement)
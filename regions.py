@@ -0,0 +1,38 @@
+from sentinelsat import read_geojson, geojson_to_wkt
+
+# Define the regions to process. Every L2 product is imported once and binned onto the grid of every region.
+# geojson: boundary used to query the products, bounds: extent of the L3 grid (west, south, east, north), the cell size of the
+# grid is defined per product in process.py, extent: map extent [west, east, south, north], output_dir: directory of the PNG/JPG/GIF outputs,
+# zones: polygons (GeoJSON, e.g. provinces) and the feature property naming each polygon, used for the zonal statistics (zonal.py)
+regions = {
+    'Thailand': {
+        'geojson': 'Support_Files/thailand_boundary_simple.geojson',     # geojson downloaded from: https://cartographyvectors.com/map/1048-thailand-detailed-boundary
+        'bounds': (95, 5, 110, 21),
+        'extent': [95, 108, 5, 21],
+        'output_dir': 'Output/',
+        'zones': {'geojson': 'Support_Files/thailand_boundary_simple.geojson', 'name_property': 'name'},     # replace by an admin-1 (province) GeoJSON for per-province statistics
+    },
+}
+
+
+# Return the bounds (west, south, east, north) of the grid of a region
+def region_bounds(region):
+    return regions[region]['bounds']
+
+
+# Return the HARP bin_spatial arguments of the grid of a region with the given cell size (degrees): number of latitude edges,
+# southern edge, latitude cell size, number of longitude edges, western edge, longitude cell size
+def region_grid(region, cell_size):
+    west, south, east, north = region_bounds(region)
+    return round((north - south) / cell_size) + 1, south, cell_size, round((east - west) / cell_size) + 1, west, cell_size
+
+
+# Return the bounds (west, south, east, north) enclosing the grids of all regions
+def union_bounds():
+    bounds = [region_bounds(region) for region in regions]
+    return min(b[0] for b in bounds), min(b[1] for b in bounds), max(b[2] for b in bounds), max(b[3] for b in bounds)
+
+
+# Return the boundary of a region as WKT
+def region_area(region):
+    return geojson_to_wkt(read_geojson(regions[region]['geojson']))
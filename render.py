@@ -0,0 +1,180 @@
+import os
+
+import matplotlib
+matplotlib.use('Agg')   # Figures are only saved to files, also by the rendering processes
+
+import cartopy.crs as ccrs
+import cartopy.feature as cf
+import matplotlib.pyplot as plt
+import numpy as np
+from cartopy.mpl.gridliner import LONGITUDE_FORMATTER, LATITUDE_FORMATTER
+from matplotlib_scalebar.scalebar import ScaleBar
+from shapely.geometry import box
+
+# Define the number of parallel rendering processes
+num_render_workers = min(os.cpu_count() or 1, 6)
+
+# Define the margin (degrees) around the map extent the basemap geometries are clipped to
+basemap_margin = 1
+
+# Define the Natural Earth layers of the basemap (layer: [category, name])
+basemap_layers = {
+    'countries': ['cultural', 'admin_0_countries'],
+    'coastlines': ['physical', 'coastline'],
+    'borders': ['cultural', 'admin_0_boundary_lines_land'],
+}
+
+# Define the diverging colormap of the anomaly maps (centred on no anomaly)
+anomaly_cmap = 'RdBu_r'
+
+# Define the data source and credits printed on the outputs
+credits = ['Data: ESA Sentinel-5P / TROPOMI', 'Credits: Contains Copernicus data (2023) processed by GIC AIT']
+
+
+# Read the 10m Natural Earth layers of the basemap once and clip them to the map extent [west, east, south, north].
+# The clipped geometries are shared by every figure of a region, so the shapefiles are not read again for every map
+def prepare_basemap(extent):
+    west, east, south, north = extent
+    clip_box = box(west - basemap_margin, south - basemap_margin, east + basemap_margin, north + basemap_margin)
+    basemap = {}
+    for layer, (category, name) in basemap_layers.items():
+        feature = cf.NaturalEarthFeature(category=category, name=name, scale='10m')
+        geometries = [geometry.intersection(clip_box) for geometry in feature.intersecting_geometries(
+            [west - basemap_margin, east + basemap_margin, south - basemap_margin, north + basemap_margin])]
+        basemap[layer] = [geometry for geometry in geometries if not geometry.is_empty]
+    return basemap
+
+
+# Calculate the distance (m) of one degree of longitude at a latitude (haversine formula, for the scalebar)
+def scalebar_distance(latitude):
+    lat_A = lat_B = latitude * np.pi / 180.
+    dlon = 1 * np.pi / 180.
+    a = np.cos(lat_A) * np.cos(lat_B) * np.sin(dlon / 2) ** 2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return 6371000 * c
+
+
+# Draw a mean on a regular latitude/longitude grid as an image (one quad per cell is not needed for a regular grid)
+def draw_grid(ax, data, vmin, vmax, cmap='magma_r'):
+    data = data.sortby(['latitude', 'longitude'])
+    latitude, longitude = data['latitude'].values, data['longitude'].values
+    latitude_step = (latitude[-1] - latitude[0]) / max(latitude.size - 1, 1)
+    longitude_step = (longitude[-1] - longitude[0]) / max(longitude.size - 1, 1)
+    extent = [longitude[0] - longitude_step / 2, longitude[-1] + longitude_step / 2, latitude[0] - latitude_step / 2, latitude[-1] + latitude_step / 2]
+    return ax.imshow(data.values, origin='lower', extent=extent, transform=ccrs.PlateCarree(), cmap=cmap,
+                     vmin=vmin, vmax=vmax, interpolation='nearest', zorder=3)
+
+
+# Draw the basemap layers prepared by prepare_basemap
+def draw_basemap(ax, basemap, linewidth=None):
+    ax.add_geometries(basemap['countries'], ccrs.PlateCarree(), facecolor='#DEDEDE', edgecolor='black', linewidth=linewidth)
+    ax.add_geometries(basemap['coastlines'], ccrs.PlateCarree(), facecolor='none', edgecolor='black', linewidth=linewidth, zorder=3)
+    ax.add_geometries(basemap['borders'], ccrs.PlateCarree(), facecolor='none', edgecolor='black', linewidth=linewidth, zorder=3)
+
+
+# Render a grid to a PNG file with a title, the time period and a colorbar
+def render_map_png(path, region_name, extent, basemap, scalebar_latitude, data, period, cmap, vmin, vmax, title, label):
+    start_date, end_date = period
+
+    # Set figure size
+    fig = plt.figure(figsize=(10, 13))
+
+    # Main map
+    ax = fig.add_subplot(1, 1, 1, projection=ccrs.PlateCarree())
+    ax.set_extent(extent)
+    im = draw_grid(ax, data, vmin, vmax, cmap=cmap)
+
+    # Add scalebar
+    ax.add_artist(
+        ScaleBar(dx=scalebar_distance(scalebar_latitude), units='m', length_fraction=0.2, location='lower right', sep=5, pad=0.4, border_pad=1,
+                 box_alpha=0.4))
+
+    # Add text
+    ax.text(0, 1.07, title, fontsize=17, transform=ax.transAxes)
+    dates_str = f'{start_date.date()} – {end_date.date()}'
+    ax.text(0, 1.02, f'{region_name}, {dates_str}', fontsize=13, transform=ax.transAxes)
+    ax.text(0.45, -0.13, '\n'.join(credits), fontsize=10, color='gray', multialignment='right', transform=ax.transAxes)
+
+    # Add countries and boundaries
+    draw_basemap(ax, basemap)
+
+    # Set colorbar properties
+    cbar_ax = fig.add_axes([0.15, 0.05, 0.25, 0.01])  # left, bottom, width, height
+    cbar = plt.colorbar(im, cax=cbar_ax, orientation='horizontal')
+    cbar.locator = plt.MaxNLocator(nbins=4)
+    cbar.set_label(label, labelpad=-50, fontsize=11, loc='left')
+    cbar.outline.set_visible(False)
+
+    # Set plot frame
+    gl = ax.gridlines(draw_labels=True, linewidth=1, color='gray', alpha=0.3, linestyle=':', zorder=3)
+    gl.top_labels = False
+    gl.right_labels = False
+    gl.xformatter = LONGITUDE_FORMATTER
+    gl.yformatter = LATITUDE_FORMATTER
+
+    plt.savefig(path, bbox_inches='tight', dpi=150, transparent=False)
+    plt.close(fig)
+    return path
+
+
+# Render the mean of a product to a PNG file
+def render_product_png(path, region_name, extent, basemap, scalebar_latitude, product, data, period, attributes):
+    return render_map_png(path, region_name, extent, basemap, scalebar_latitude, data, period, 'magma_r', attributes[2], attributes[3],
+                          f'Average top of {attributes[5]} {product} concentrations', fr'{attributes[1]} ({attributes[4]})')
+
+
+# Render the anomaly of a product (absolute or z-score) to a PNG file, on a diverging colour scale from -limit to limit
+def render_anomaly_png(path, region_name, extent, basemap, scalebar_latitude, data, period, title, label, limit):
+    return render_map_png(path, region_name, extent, basemap, scalebar_latitude, data, period, anomaly_cmap, -limit, limit, title, label)
+
+
+# Render the means of all products to a single JPG file with one map per product
+def render_all_products_jpg(path, region_name, extent, basemap, scalebar_latitude, product_means, product_periods, product_attributes):
+    # Define figure size and variable to increment for subplots
+    fig = plt.figure(figsize=(16, 5))
+    num = 0
+
+    for product, data in product_means.items():
+        start_date, end_date = product_periods[product]
+        attributes = product_attributes[product]
+
+        # Create subplots
+        num += 1
+        ax = fig.add_subplot(1, 5, num, projection=ccrs.PlateCarree())
+        ax.set_extent(extent)
+        im = draw_grid(ax, data, attributes[2], attributes[3])
+
+        # Add scalebar
+        ax.add_artist(
+            ScaleBar(dx=scalebar_distance(scalebar_latitude), units='m', length_fraction=0.2, location='lower right', sep=5, pad=0.3, border_pad=0.1,
+                     box_alpha=0.4, font_properties={'size': 6}))
+
+        # Add countries and boundaries
+        draw_basemap(ax, basemap, linewidth=0.2)
+
+        # Set colorbar properties
+        cbar = plt.colorbar(im, ax=ax, orientation='horizontal', aspect=30)
+        cbar.ax.tick_params(labelsize=6)
+        cbar.locator = plt.MaxNLocator(nbins=4)
+        cbar.set_label(fr'{attributes[1]} ({attributes[4]})', labelpad=-30, fontsize=6, loc='left')
+        cbar.outline.set_visible(False)
+
+        # Set plot frame
+        gl = ax.gridlines(draw_labels=True, xlabel_style={'size': 6}, ylabel_style={'size': 6}, linewidth=1, color='gray', alpha=0.3, linestyle=':', zorder=3)
+        gl.top_labels = False
+        gl.right_labels = False
+        gl.xformatter = LONGITUDE_FORMATTER
+        gl.yformatter = LATITUDE_FORMATTER
+
+        # Add text to subplots
+        ax.text(0, 1.07, f'Average top of {attributes[5]} {product} concentrations', fontsize=6, transform=ax.transAxes)
+        dates_str = f'{start_date.date()} – {end_date.date()}'
+        ax.text(0, 1.02, f'{region_name}, {dates_str}', fontsize=5, transform=ax.transAxes)
+
+    # Add text to main plot
+    if num:
+        fig.text(-0.90, -0.4, '. '.join(credits), fontsize=6, color='gray', multialignment='right', transform=ax.transAxes)
+
+    plt.savefig(path, bbox_inches='tight', dpi=600, transparent=False)
+    plt.close(fig)
+    return path
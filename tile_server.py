@@ -0,0 +1,231 @@
+import asyncio
+import io
+import json
+import os
+import re
+import sys
+import threading
+from collections import OrderedDict
+from urllib.parse import parse_qs, urlparse
+
+import matplotlib
+import numpy as np
+import xarray as xr
+
+import aggregate
+import export
+import regions
+
+# Local HTTP service serving colour-mapped XYZ tiles and point/bbox values of the latest mean of every product and region.
+# Usage: python tile_server.py [port]
+#   /products                                              latest mean of every region and product
+#   /tiles/[region]/[product]/[zoom]/[x]/[y].png           XYZ (web mercator) PNG tile
+#   /point/[region]/[product]?lat=[lat]&lon=[lon]          value of the grid cell containing a point
+#   /bbox/[region]/[product]?west=&south=&east=&north=     mean, min, max and number of valid cells inside a bounding box
+
+# Define the port to listen on
+port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+
+# Define the directory the mean grids are stored in as memory-mappable arrays (one sub-directory per region)
+grid_cache_dir = 'Products_Mean_Grids/'
+
+# Define the maximum number of rendered tiles kept in memory (least recently used tiles are dropped first)
+tile_cache_size = 4096
+
+# Define the interval (seconds) in which the mean directory is checked for new means
+reload_interval = 300
+
+# Latest mean of every region and product ((region, product): {'name', 'version', 'grid', 'values', 'latitude', 'longitude', 'start', 'end'})
+means = {}
+
+# Rendered tiles, keyed by mean file name, version and tile coordinates (shared by the worker threads rendering the tiles)
+tile_cache = OrderedDict()
+tile_cache_lock = threading.Lock()
+
+
+# Return the cached mean file with the latest time period of every product of a region
+def latest_mean_files(region):
+    region_dir = os.path.join(aggregate.mean_dir, region)
+    latest = {}
+    if not os.path.isdir(region_dir):
+        return latest
+    for filename in sorted(os.listdir(region_dir)):
+        match = re.fullmatch(r'(\w+?)_(\d{8})-(\d{8})\.nc', filename)
+        if match and match.group(1) in aggregate.product_attributes:
+            product, start, end = match.groups()
+            if product not in latest or (end, start) > latest[product][1:]:
+                latest[product] = (filename, start, end)
+    return latest
+
+
+# Return the version of a mean file (its modification time). A mean is rewritten under the same name when late-arriving or
+# OFFL products of its time period are aggregated (see aggregate.cached_period_mean)
+def mean_version(region, filename):
+    return os.stat(os.path.join(aggregate.mean_dir, region, filename)).st_mtime_ns
+
+
+# Load a version of a mean as a memory-mapped array. The grid of the NetCDF file is stored as .npy file once per version, later
+# loads only map the file
+def load_mean(region, filename, version):
+    grid_path = os.path.join(grid_cache_dir, region, f'{filename[:-3]}_{version}.npy')
+    with xr.open_dataset(os.path.join(aggregate.mean_dir, region, filename)) as ds:
+        mean = ds[list(ds.data_vars)[0]].sortby(['latitude', 'longitude'])
+        latitude, longitude = mean['latitude'].values, mean['longitude'].values
+        if not os.path.exists(grid_path):
+            os.makedirs(os.path.dirname(grid_path), exist_ok=True)
+            np.save(grid_path + '.part.npy', mean.values.astype('float32'))
+            os.replace(grid_path + '.part.npy', grid_path)
+    return np.load(grid_path, mmap_mode='r'), latitude, longitude, os.path.basename(grid_path)
+
+
+# Drop the rendered tiles of a mean from the tile cache
+def drop_tiles(region, filename):
+    with tile_cache_lock:
+        for key in [key for key in tile_cache if key[:2] == (region, filename)]:
+            del tile_cache[key]
+
+
+# Load the latest mean of every region and product, if it changed since the last load, and delete outdated grid files
+def reload_means():
+    for region in regions.regions:
+        for product, (filename, start, end) in latest_mean_files(region).items():
+            try:
+                version = mean_version(region, filename)
+                if (region, product) in means and (means[(region, product)]['name'], means[(region, product)]['version']) == (filename, version):
+                    continue
+                values, latitude, longitude, grid = load_mean(region, filename, version)
+            except Exception as error:
+                print(f'Error: {error}. Skipping {filename}.')
+                continue
+            if (region, product) in means:
+                drop_tiles(region, means[(region, product)]['name'])
+            means[(region, product)] = {'name': filename, 'version': version, 'grid': grid, 'values': values, 'latitude': latitude,
+                                        'longitude': longitude, 'start': start, 'end': end}
+            print(f'Loaded: {region} {filename}')
+        region_grid_dir = os.path.join(grid_cache_dir, region)
+        if os.path.isdir(region_grid_dir):
+            loaded = {mean['grid'] for (mean_region, _), mean in means.items() if mean_region == region}
+            for filename in os.listdir(region_grid_dir):
+                if filename not in loaded:
+                    os.remove(os.path.join(region_grid_dir, filename))
+
+
+# Render a tile of a mean to PNG, rendered tiles are kept in a bounded LRU cache
+def tile_png(region, product, zoom, x, y):
+    mean = means[(region, product)]
+    key = (region, mean['name'], mean['version'], zoom, x, y)
+    with tile_cache_lock:
+        if key in tile_cache:
+            tile_cache.move_to_end(key)
+            return tile_cache[key]
+    vmin, vmax = aggregate.product_attributes[product][2:4]     # same value range as the maps
+    tile = export.render_tile(mean['values'], mean['latitude'], mean['longitude'], x, y, zoom,
+                              matplotlib.colormaps[export.tile_colormap], matplotlib.colors.Normalize(vmin=vmin, vmax=vmax))
+    buffer = io.BytesIO()
+    tile.save(buffer, format='PNG')
+    with tile_cache_lock:
+        tile_cache[key] = buffer.getvalue()
+        if len(tile_cache) > tile_cache_size:
+            tile_cache.popitem(last=False)
+    return buffer.getvalue()
+
+
+# Return the indices of the grid cells of a mean inside a bounding box (rows, columns as slices)
+def bbox_window(mean, west, south, east, north):
+    rows = np.searchsorted(mean['latitude'], [south, north])
+    columns = np.searchsorted(mean['longitude'], [west, east])
+    return slice(rows[0], rows[1]), slice(columns[0], columns[1])
+
+
+# Return the index of the cell centre of a regular grid axis nearest to a coordinate, None if the coordinate is more than half
+# a cell outside the grid
+def cell_index(centres, coordinate):
+    index = int(np.abs(centres - coordinate).argmin())
+    half_cell = np.abs(np.diff(centres)).min() / 2 if centres.size > 1 else 0
+    return index if abs(centres[index] - coordinate) <= half_cell else None
+
+
+# Return the value of the grid cell of a mean containing a point, None if the point is outside the grid
+def point_value(mean, latitude, longitude):
+    row = cell_index(mean['latitude'], latitude)
+    column = cell_index(mean['longitude'], longitude)
+    if row is None or column is None:
+        return None
+    value = float(mean['values'][row, column])
+    return {'latitude': float(mean['latitude'][row]), 'longitude': float(mean['longitude'][column]), 'value': None if np.isnan(value) else value}
+
+
+# Return the statistics of the grid cells of a mean inside a bounding box
+def bbox_statistics(mean, west, south, east, north):
+    rows, columns = bbox_window(mean, west, south, east, north)
+    window = np.asarray(mean['values'][rows, columns])
+    valid = window[~np.isnan(window)]
+    if valid.size == 0:
+        return {'mean': None, 'min': None, 'max': None, 'valid_count': 0}
+    return {'mean': float(valid.mean()), 'min': float(valid.min()), 'max': float(valid.max()), 'valid_count': int(valid.size)}
+
+
+# Answer a request path with a status, content type and body
+def handle_path(path, parameters):
+    parts = [part for part in path.split('/') if part]
+    if parts == ['products']:
+        body = [{'region': region, 'product': product, 'start': mean['start'], 'end': mean['end']} for (region, product), mean in list(means.items())]
+        return 200, 'application/json', json.dumps(body).encode()
+    if len(parts) < 3 or (parts[1], parts[2]) not in means:
+        return 404, 'application/json', json.dumps({'error': 'not found'}).encode()
+    region, product = parts[1], parts[2]
+    mean = means[(region, product)]
+    if parts[0] == 'tiles' and len(parts) == 6 and parts[5].endswith('.png'):
+        return 200, 'image/png', tile_png(region, product, int(parts[3]), int(parts[4]), int(parts[5][:-4]))
+    if parts[0] == 'point':
+        body = point_value(mean, float(parameters['lat'][0]), float(parameters['lon'][0]))
+        if body is None:
+            return 404, 'application/json', json.dumps({'error': 'point outside the grid'}).encode()
+    elif parts[0] == 'bbox':
+        body = bbox_statistics(mean, *(float(parameters[name][0]) for name in ['west', 'south', 'east', 'north']))
+    else:
+        return 404, 'application/json', json.dumps({'error': 'not found'}).encode()
+    body.update({'region': region, 'product': product, 'start': mean['start'], 'end': mean['end']})
+    return 200, 'application/json', json.dumps(body).encode()
+
+
+# Handle a single HTTP request of a connection. Tiles are rendered in a worker thread, so other requests are not blocked
+async def handle_connection(reader, writer):
+    try:
+        request_line = (await reader.readline()).decode('latin-1').split()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        if len(request_line) < 2 or request_line[0] != 'GET':
+            status, content_type, body = 405, 'application/json', json.dumps({'error': 'method not allowed'}).encode()
+        else:
+            url = urlparse(request_line[1])
+            try:
+                status, content_type, body = await asyncio.get_running_loop().run_in_executor(None, handle_path, url.path, parse_qs(url.query))
+            except (KeyError, ValueError, IndexError) as error:
+                status, content_type, body = 400, 'application/json', json.dumps({'error': f'invalid request: {error}'}).encode()
+        reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed'}[status]
+        writer.write(f'HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n'
+                     f'Access-Control-Allow-Origin: *\r\nConnection: close\r\n\r\n'.encode() + body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+# Check the mean directory for new means in regular intervals
+async def reload_periodically():
+    while True:
+        await asyncio.sleep(reload_interval)
+        await asyncio.get_running_loop().run_in_executor(None, reload_means)
+
+
+async def main():
+    reload_means()
+    server = await asyncio.start_server(handle_connection, port=port)
+    print(f'Serving {len(means)} means on port {port}')
+    asyncio.get_running_loop().create_task(reload_periodically())
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,133 @@
+import hashlib
+import json
+import os
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import shapely
+from shapely.geometry import shape
+
+import aggregate
+import regions
+
+# Define the directory to save the zonal statistics time series to (one file per region)
+zonal_dir = 'Output_Zonal/'
+
+# Define the directory to cache the zone index of each grid in (one sub-directory per region)
+zone_index_dir = 'Products_Zones/'
+
+# Define the format of the zonal statistics time series: 'csv' or 'parquet' (requires pyarrow)
+zonal_format = 'csv'
+
+# Define time variables
+current_date = datetime.now()
+
+
+# Read the polygons and names of the zones of a region
+def read_zones(region):
+    zones = regions.regions[region]['zones']
+    with open(zones['geojson']) as file:
+        features = json.load(file)['features']
+    return [feature['properties'].get(zones['name_property'], str(index)) for index, feature in enumerate(features)], \
+        [shape(feature['geometry']) for feature in features]
+
+
+# Return a key identifying the zones of a region and a grid. The key changes whenever the zone file or the grid changes
+def zone_index_key(region, latitude, longitude):
+    key = hashlib.sha1()
+    zones = regions.regions[region]['zones']
+    status = os.stat(zones['geojson'])
+    key.update(f'{zones["geojson"]}:{zones["name_property"]}:{status.st_mtime_ns}:{status.st_size};'.encode())
+    key.update(latitude.tobytes())
+    key.update(longitude.tobytes())
+    return key.hexdigest()
+
+
+# Assign every cell of a grid to the zone containing its centre (-1 for cells outside all zones). Only the cells inside
+# the bounding box of a zone are tested, cells inside several zones are assigned to the first zone
+def rasterize_zones(geometries, latitude, longitude):
+    zone_index = np.full((latitude.size, longitude.size), -1, dtype='int32')
+    for zone, geometry in enumerate(geometries):
+        west, south, east, north = geometry.bounds
+        rows = np.flatnonzero((latitude >= south) & (latitude <= north))
+        columns = np.flatnonzero((longitude >= west) & (longitude <= east))
+        if rows.size == 0 or columns.size == 0:
+            continue
+        shapely.prepare(geometry)
+        cell_longitude, cell_latitude = np.meshgrid(longitude[columns], latitude[rows])
+        inside = shapely.contains_xy(geometry, cell_longitude, cell_latitude)
+        window = zone_index[rows[0]:rows[-1] + 1, columns[0]:columns[-1] + 1]
+        window[inside & (window == -1)] = zone
+    return zone_index
+
+
+# Return the zone index of a grid, rasterizing the zones only if they or the grid changed since the index was cached
+def cached_zone_index(region, latitude, longitude):
+    key = zone_index_key(region, latitude, longitude)
+    path = os.path.join(zone_index_dir, region, f'{key}.npz')
+    if os.path.exists(path):
+        with np.load(path) as cached:
+            return list(cached['names']), cached['zone_index']
+    names, geometries = read_zones(region)
+    zone_index = rasterize_zones(geometries, latitude, longitude)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    np.savez_compressed(path + '.part.npz', names=np.array(names), zone_index=zone_index)
+    os.replace(path + '.part.npz', path)
+    return names, zone_index
+
+
+# Calculate the mean, maximum and number of valid cells of a grid for every zone in a single pass over the grid
+def zone_statistics(values, zone_index, zone_count):
+    valid = ~np.isnan(values) & (zone_index >= 0)
+    zones, values = zone_index[valid], values[valid]
+    counts = np.bincount(zones, minlength=zone_count)
+    sums = np.bincount(zones, weights=values, minlength=zone_count)
+    maxima = np.full(zone_count, -np.inf)
+    np.maximum.at(maxima, zones, values)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(counts > 0, sums / counts, np.nan)
+    maxima[counts == 0] = np.nan
+    return means, maxima, counts
+
+
+# Return the path of the zonal statistics time series of a region
+def zonal_path(region):
+    return os.path.join(zonal_dir, f'{region}_zonal_statistics.{zonal_format}')
+
+
+# Add the statistics of a time period to the zonal statistics time series of a region. Rows of the same time period and
+# product are replaced, so running the stage again for a period does not duplicate rows
+def update_time_series(region, rows):
+    path = zonal_path(region)
+    time_series = pd.DataFrame(rows)
+    if os.path.exists(path):
+        previous = pd.read_csv(path) if zonal_format == 'csv' else pd.read_parquet(path)
+        replaced = previous.set_index(['start_date', 'end_date', 'product']).index.isin(time_series.set_index(['start_date', 'end_date', 'product']).index)
+        time_series = pd.concat([previous[~replaced], time_series], ignore_index=True)
+    time_series = time_series.sort_values(['end_date', 'product', 'zone'], kind='stable')
+    os.makedirs(zonal_dir, exist_ok=True)
+    if zonal_format == 'csv':
+        time_series.to_csv(path + '.part', index=False)
+    else:
+        time_series.to_parquet(path + '.part', index=False)
+    os.replace(path + '.part', path)
+
+
+if __name__ == '__main__':
+    for region in regions.regions:
+        rows = []
+        product_means, product_periods = aggregate.region_means(region, current_date)
+        for product, mean in product_means.items():
+            start_date, end_date = product_periods[product]
+            names, zone_index = cached_zone_index(region, mean['latitude'].values, mean['longitude'].values)
+            zone_means, zone_maxima, zone_counts = zone_statistics(mean.values, zone_index, len(names))
+            for zone, name in enumerate(names):
+                rows.append({
+                    'start_date': start_date.date().isoformat(), 'end_date': end_date.date().isoformat(), 'product': product,
+                    'zone': name, 'mean': zone_means[zone], 'max': zone_maxima[zone], 'valid_count': int(zone_counts[zone])
+                })
+            print(f'{region} {product}: statistics of {len(names)} zones calculated')
+        if rows:
+            update_time_series(region, rows)
+            print(f'Saved: {zonal_path(region)}')